@@ -1,14 +1,22 @@
 import boto
 import boto.s3.connection
 
-import sys, time, os, glob
+import sys, time, os, mmap, tempfile, random
 import zlib, codecs
 import pickle
 
 import numpy as np
+import numba
 import regex as re
 from datetime import datetime
+from functools import lru_cache, partial
 import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import metrics
+from manifest import write_atomic, write_manifest, is_complete
+from utils import ColumnarCounts, _nmb_permute_rows
 
 
 def build_prefix(lang, n, version='20120701'):
@@ -38,39 +46,70 @@ def key_basename(key):
     return key.name.rsplit('-', 1)[-1].split('.')[0]
 
 
+def decompress_members(extracter, chunk):
+    """ Decompresses `chunk` with `extracter`, going on with a new decompressor for each gzip member starting
+    in it, like `gzip` does for concatenated members. Returns (extracter of the current member, data) """
+    data = extracter.decompress(chunk)
+    while extracter.eof and extracter.unused_data:
+        chunk = extracter.unused_data
+        extracter = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data += extracter.decompress(chunk)
+    return extracter, data
+
+
 def decompress_stream(stream):
     """ Given an iterable stream of gzipped data (such as a `key` in S3 storage), this function returns an iterator
-    over the uncompressed and utf-8 decoded data """
+    over the uncompressed and utf-8 decoded data. All the gzip members of the stream are read """
     extracter = zlib.decompressobj(16 + zlib.MAX_WBITS)
     decoder   = codecs.getincrementaldecoder('utf-8')()  # note the second () which instantiates the object
 
     for chunk in stream:
-        yield decoder.decode( extracter.decompress(chunk) )
+        extracter, data = decompress_members(extracter, chunk)
+        yield decoder.decode(data)
 
     yield decoder.decode( extracter.flush() , final = True)
 
 
+# compiled once, since they run for every new block
+INVALID_TOKEN = re.compile(r"[^\p{Lu}\p{Ll}_' ]|\b_[A-Z]*_\b")
+POS_TAG       = re.compile(r'_[A-Z]*\b')
+
+
+@lru_cache(maxsize=2**20)
+def clean_token(token):
+    """ Returns the clean form of a single token of an n-gram, or None if it is invalid.
+    Cached, since the same token shows up in many n-grams and POS-tagged variants (word_NOUN, word_VERB) """
+    # skip if it's not letters only (and _ apostrophe) or is _ADJ_
+    if INVALID_TOKEN.search(token):
+        return None
+           # remove POS tags   # lower
+    return POS_TAG.sub('', token).lower()
+
+
 def get_entry(word, range_size):
     """ Given `word` returns its clean form and an integer array if it is valid
     or the empty string and None if it is invalid """
-    # skip if it's not letters only (and space _ apostrophe) or is "word _ADJ_
-    # TODO: check this works for 3-grams etc
-    if re.search(r"[^\p{Lu}\p{Ll}_' ]|\b_[A-Z]*_\b", word):
+    # the patterns can't match across spaces, so cleaning token by token is the same as cleaning the whole n-gram
+    tokens = [clean_token(token) for token in word.split(' ')]
+    if None in tokens:
         return "", None
 
-           # remove POS tags             #lower
-    return re.sub(r'_[A-Z]*\b', '', word).lower(),\
-           np.zeros(range_size, dtype=np.uint32)    # array of counts
+    return ' '.join(tokens), np.zeros(range_size, dtype=np.uint32)    # array of counts
+
+
+def cache_stats():
+    """ (hits, misses) of the token cleaning cache in this process """
+    info = clean_token.cache_info()
+    return info.hits, info.misses
 
 
 def save_counts(counts, save_path):
-    """ Serializes the dict of counts """
-    with open(save_path, 'wb') as f:
-        pickle.dump(counts, f, pickle.HIGHEST_PROTOCOL)
+    """ Serializes the dict of counts. The file appears only once it is complete """
+    write_atomic(save_path, lambda f: pickle.dump(counts, f, pickle.HIGHEST_PROTOCOL))
 
 
-def process_key(key, save_path, start_year=1840, end_year=2001):
-    """ Given the keyname, save a dictionary of the wordcount aggregates """
+def count_words(stream, start_year, end_year):
+    """ Given an iterable of gzipped chunks, returns the dictionary of the wordcount aggregates """
 
     # setup the counting structure
     range_size = end_year - start_year # open interval
@@ -86,7 +125,7 @@ def process_key(key, save_path, start_year=1840, end_year=2001):
     word_default_entry = np.zeros(range_size, dtype=np.uint32)
 
     prev_chunk_end  = u""
-    for chunk in decompress_stream(key):
+    for chunk in decompress_stream(stream):
         lines = chunk.split('\n')
 
         # complete chunk with the ending of previous one
@@ -119,34 +158,440 @@ def process_key(key, save_path, start_year=1840, end_year=2001):
             idx = year - start_year
             word_entry[idx] += int(count)
 
-    # we finished, we save it
+    return word_counts
+
+
+def decompress_bytes(stream, block_size=2**20):
+    """ Like `decompress_stream`, but yields the raw (not decoded) data in blocks of at least `block_size` bytes,
+    so that the per-block overhead of the byte parser is amortised """
+    extracter = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    block = bytearray()
+
+    stream = iter(stream)
+    while True:
+        # time blocked waiting for the data
+        wait_start = time.perf_counter()
+        chunk = next(stream, None)
+        metrics.add('network_s', time.perf_counter() - wait_start)
+        if chunk is None:
+            break
+
+        extracter, data = decompress_members(extracter, chunk)
+        block += data
+        if len(block) >= block_size:
+            metrics.add('bytes', len(block))
+            yield block
+            block = bytearray()
+
+    block += extracter.flush()
+    metrics.add('bytes', len(block))
+    yield block
+
+
+@numba.jit(nopython=True)
+def _nmb_parse_lines(buf, start_year, end_year):
+    """ Parses the complete lines of `buf`, a uint8 array of "ngram TAB year TAB match_count TAB volume_count NL".
+    Consecutive lines with the same n-gram form a block, whose counts in [start_year, end_year) are summed.
+
+    Returns (end, word_starts, word_ends, block_counts), where `end` is the offset after the last complete line
+    and row `i` of `block_counts` holds the counts of the n-gram at `buf[word_starts[i]:word_ends[i]]` """
+    range_size = end_year - start_year
+
+    # find the end of the last complete line, the rest is left for the next call
+    end = len(buf)
+    while end > 0 and buf[end - 1] != 10:
+        end -= 1
+
+    num_lines = 0
+    for i in range(end):
+        if buf[i] == 10:
+            num_lines += 1
+
+    line_block = np.empty(num_lines, dtype=np.int64)
+    line_year  = np.empty(num_lines, dtype=np.int64)
+    line_count = np.empty(num_lines, dtype=np.int64)
+    word_starts = np.empty(num_lines, dtype=np.int64)
+    word_ends   = np.empty(num_lines, dtype=np.int64)
+
+    num_blocks = 0
+    prev_start, prev_end = 0, -1
+    pos = 0
+    for line in range(num_lines):
+        # the n-gram
+        start = pos
+        while buf[pos] != 9:
+            pos += 1
+        stop = pos
+        pos += 1
+
+        # the year
+        year = 0
+        while buf[pos] != 9:
+            year = year * 10 + buf[pos] - 48
+            pos += 1
+        pos += 1
+
+        # the match count
+        count = 0
+        while buf[pos] != 9:
+            count = count * 10 + buf[pos] - 48
+            pos += 1
+
+        # skip the volume count
+        while buf[pos] != 10:
+            pos += 1
+        pos += 1
+
+        # compare with the previous n-gram to detect a new block
+        same = stop - start == prev_end - prev_start
+        k = 0
+        while same and k < stop - start:
+            same = buf[start + k] == buf[prev_start + k]
+            k += 1
+        if not same:
+            word_starts[num_blocks] = start
+            word_ends[num_blocks]   = stop
+            num_blocks += 1
+            prev_start, prev_end = start, stop
+
+        line_block[line] = num_blocks - 1
+        line_year[line]  = year - start_year
+        line_count[line] = count
+
+    block_counts = np.zeros((num_blocks, range_size), dtype=np.uint32)
+    for line in range(num_lines):
+        idx = line_year[line]
+        if 0 <= idx < range_size:
+            block_counts[line_block[line], idx] += line_count[line]
+
+    return end, word_starts[:num_blocks], word_ends[:num_blocks], block_counts
+
+
+def iter_line_blocks(blocks):
+    """ Re-cuts an iterable of byte blocks so that each one ends with a complete line.
+    The trailing data without an end of line is dropped, as `count_words` does """
+    prev_block_end = b""
+    for block in blocks:
+        block = prev_block_end + block
+        end = block.rfind(b'\n') + 1
+        prev_block_end = block[end:]
+        if end:
+            yield block[:end]
+
+
+def add_block(word_counts, word_line, counts, range_size):
+    """ Adds the counts of a complete block of raw n-gram `word_line` (bytes) to `word_counts`,
+    if the n-gram is valid and frequent enough """
+    if counts.sum() > range_size * 35:
+        regex_start = time.perf_counter()
+        word_clean, _ = get_entry(word_line.decode('utf-8'), range_size)
+        metrics.add('regex_s', time.perf_counter() - regex_start)
+        if word_clean:
+            # adding because of `.lower()`
+            word_counts[word_clean] = counts + word_counts.get(word_clean, 0)
+
+
+def parse_region(buf, start_year, end_year):
+    """ Parses a region made of complete lines, independently of the others.
+
+    The first and last blocks may continue in the neighbouring regions, so they are returned raw, as
+    `(word_line, counts)`, for `merge_regions` to complete. Returns `(first, word_counts, last)`, where
+    `word_counts` holds the blocks in between and `last` is None if the region has a single block. """
+    range_size = end_year - start_year # open interval
+    parse_start = time.perf_counter()
+    metrics.add('lines', buf.count(b'\n'))
+    buf = np.frombuffer(buf, dtype=np.uint8)
+    _, word_starts, word_ends, block_counts = _nmb_parse_lines(buf, start_year, end_year)
+    metrics.add('parse_s', time.perf_counter() - parse_start)
+    if not len(word_starts):
+        return None, {}, None
+    raw = buf.data
+
+    def block(i):
+        return bytes(raw[word_starts[i]:word_ends[i]]), block_counts[i]
+
+    # most blocks are too rare, so they are skipped before looking at the n-gram
+    word_counts = {}
+    frequent = np.flatnonzero(block_counts[1:-1].sum(axis=1) > range_size * 35) + 1
+    for i in frequent:
+        add_block(word_counts, *block(i), range_size)
+
+    last = block(len(word_starts) - 1) if len(word_starts) > 1 else None
+    return block(0), word_counts, last
+
+
+def merge_regions(regions, start_year, end_year):
+    """ Merges the results of `parse_region` for consecutive regions, given in order.
+    A block running over several regions is summed before it's checked, so the result is the same as
+    parsing all the regions at once """
+    range_size = end_year - start_year # open interval
+    word_counts = {}
+
+    # the block that may continue in the next region
+    pending_line, pending_counts = None, None
+    for first, region_counts, last in regions:
+        if first is None:
+            continue
+
+        if first[0] == pending_line:
+            pending_counts = pending_counts + first[1]
+        else:
+            if pending_line is not None:
+                add_block(word_counts, pending_line, pending_counts, range_size)
+            pending_line, pending_counts = first
+
+        if last is not None:
+            add_block(word_counts, pending_line, pending_counts, range_size)
+            for word, counts in region_counts.items():
+                word_counts[word] = counts + word_counts.get(word, 0)
+            pending_line, pending_counts = last
+
+    # NB: like `count_words`, the last block is never added, so that the output is identical
+    return word_counts
+
+
+def count_words_bytes(stream, start_year, end_year):
+    """ Same as `count_words`, but parses the raw bytes in bulk with `_nmb_parse_lines`.
+    Only the n-gram of each block is decoded and cleaned, the year/count columns never become `str` """
+    regions = (parse_region(buf, start_year, end_year) for buf in iter_line_blocks(decompress_bytes(stream)))
+    return merge_regions(regions, start_year, end_year)
+
+
+PARSE_ENGINES = {'str': count_words, 'bytes': count_words_bytes}
+
+
+def process_key(key, save_path, start_year=1840, end_year=2001, engine='bytes'):
+    """ Given the keyname, save a dictionary of the wordcount aggregates and its manifest.
+    `engine` selects the parser from `PARSE_ENGINES`; both give identical results """
+    key_start    = time.time()
+    hits, misses = cache_stats()
+    metrics.set_key(key.name)
+    word_counts  = PARSE_ENGINES[engine](key, start_year, end_year)
+    metrics.add('words', len(word_counts))
+
+    # we finished, we save it. The manifest goes last, it marks the key as done
     save_counts(word_counts, save_path)
-    return key, len(word_counts.keys())
+    write_manifest(key, save_path, len(word_counts), time.time() - key_start)
+    metrics.flush()
+
+    # the cache lives as long as the worker, so report only what this key added
+    key_hits, key_misses = cache_stats()
+    return key, len(word_counts.keys()), key_hits - hits, key_misses - misses
+
+
+def parse_region_task(buf, start_year, end_year):
+    """ `parse_region` in a worker, also reporting what it did to the cleaning cache. The counters are sent
+    with each region, since the pool of `process_large_key` is shut down right after its key """
+    hits, misses = cache_stats()
+    region = parse_region(buf, start_year, end_year)
+    key_hits, key_misses = cache_stats()
+    metrics.flush()
+    return region, key_hits - hits, key_misses - misses
+
+
+GZIP_MAGIC = b'\x1f\x8b\x08'
+
+def gzip_members(file_path, probe_size=2**16):
+    """ Offsets of the gzip members concatenated in `file_path`. A member header can also appear by chance
+    inside compressed data, so only candidates that decompress for `probe_size` bytes are kept.
+    `decompress_member` checks that each member ends exactly where the next one starts """
+    with open(file_path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        offsets = [0]
+        pos = data.find(GZIP_MAGIC, 1)
+        while pos != -1:
+            try:
+                zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data[pos:pos + probe_size])
+                offsets.append(pos)
+            except zlib.error:
+                pass
+            pos = data.find(GZIP_MAGIC, pos + 1)
+    finally:
+        data.close()
+    return offsets
+
+
+def decompress_member(file_path, start, end, start_year, end_year):
+    """ Decompresses the gzip member at [start, end) of `file_path` and parses its complete lines.
+    Lines may straddle members, so the data before the first and after the last end of line is returned
+    as is: `(head, region_task_result, tail)`. Returns None if [start, end) is not exactly one member """
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        compressed = f.read(end - start)
 
+    extracter = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        data = extracter.decompress(compressed)
+    except zlib.error:
+        return None
+    if not extracter.eof or extracter.unused_data:
+        return None
+    metrics.add('bytes', len(data))
+
+    first = data.find(b'\n') + 1
+    last  = data.rfind(b'\n') + 1
+    if first == last:    # at most one end of line, nothing to parse here
+        return data, None, b""
+    return data[:first], parse_region_task(data[first:last], start_year, end_year), data[last:]
+
+
+def parse_members(pool, file_path, offsets, start_year, end_year):
+    """ Decompresses and parses the gzip members of `file_path` starting at `offsets` in the workers of `pool`,
+    then parses the lines cut between members. Returns the regions, or None if an offset isn't really
+    the start of a member """
+    bounds  = zip(offsets, offsets[1:] + [os.path.getsize(file_path)])
+    futures = [pool.submit(decompress_member, file_path, start, end, start_year, end_year) for start, end in bounds]
+
+    # stitch the lines cut between members
+    regions, carry = [], b""
+    for future in futures:
+        member = future.result()
+        if member is None:
+            for future in futures:
+                future.cancel()
+            return None
+        head, region, tail = member
+        carry += head
+        if region is not None:
+            regions.append(parse_region_task(carry, start_year, end_year))
+            regions.append(region)
+            carry = tail
+    end = carry.rfind(b'\n') + 1
+    regions.append(parse_region_task(carry[:end], start_year, end_year))
+    return regions
+
+
+def download_key(key, scratch_dir):
+    """ Saves `key` to a temporary file in `scratch_dir` and returns its path """
+    fd, file_path = tempfile.mkstemp(prefix=key_basename(key) + '-', suffix='.gz', dir=scratch_dir)
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in key:
+            f.write(chunk)
+    return file_path
+
+
+def process_large_key(key, save_path, start_year=1840, end_year=2001, scratch_dir='/tmp', workers=None,
+                      region_size=2**24, metrics_queue=None):
+    """ Same as `process_key`, but the key is split among `workers` processes, for the largest keys.
+
+    The key is downloaded once to `scratch_dir`. If it's made of several gzip members, each is decompressed
+    and parsed by a worker. Otherwise, or if a member found by `gzip_members` turns out not to be one,
+    decompression stays sequential (zlib can't resume a deflate stream in the middle) and the decompressed
+    regions of `region_size` bytes are parsed by the workers. Both read all the members, like `process_key`.
+    Blocks of an n-gram cut between regions are merged back by `merge_regions`.
+
+    With `metrics_queue`, the workers send their counters for the key there, see `metrics.init_metrics`,
+    and so does this process, for the sequential decompression and the words kept. """
+    key_start = time.time()
+    workers   = workers or os.cpu_count()
+    metrics.set_key(key.name)
+    file_path = download_key(key, scratch_dir)
+    initializer = None if metrics_queue is None else partial(metrics.init_metrics, metrics_queue, key=key.name)
+    regions = None
+    try:
+        with ProcessPoolExecutor(workers, initializer=initializer) as pool:
+            offsets = gzip_members(file_path)
+            if len(offsets) > 1:
+                regions = parse_members(pool, file_path, offsets, start_year, end_year)
+                if regions is None:
+                    print("Invalid gzip members in", key.name, "decompressing sequentially", file=sys.stderr)
+            if regions is None:
+                regions, futures = [], []
+                for buf in iter_line_blocks(decompress_bytes(read_file(file_path), region_size)):
+                    futures.append(pool.submit(parse_region_task, buf, start_year, end_year))
+                    # bound the decompressed data waiting for a worker
+                    if len(futures) - len(regions) > 2 * workers:
+                        regions.append(futures[len(regions)].result())
+                regions += [future.result() for future in futures[len(regions):]]
+    finally:
+        os.remove(file_path)
+
+    word_counts = merge_regions((region for region, _, _ in regions), start_year, end_year)
+    metrics.add('words', len(word_counts))
+    save_counts(word_counts, save_path)
+    write_manifest(key, save_path, len(word_counts), time.time() - key_start)
+    metrics.flush()
+    return key, len(word_counts), sum(r[1] for r in regions), sum(r[2] for r in regions)
 
-def retry_process_key(*args, **kw_args):
+
+def read_file(file_path, chunk_size=2**20):
+    """ Iterates over the content of a local file in chunks """
+    with open(file_path, 'rb') as f:
+        for chunk in iter(partial(f.read, chunk_size), b''):
+            yield chunk
+
+
+# set in each worker of `aggregate_shared` by `init_shared_worker`: (matrix, next_row)
+shared_counts = None
+
+def init_shared_worker(shm_name, shape, next_row):
+    """ Attaches the worker to the shared matrix of counts and the counter of its used rows """
+    global shared_counts
+    shm = shared_memory.SharedMemory(name=shm_name)
+    init_shared_worker.shm = shm  # keep it alive as long as the worker
+    shared_counts = np.ndarray(shape, dtype=np.uint32, buffer=shm.buf), next_row
+
+
+def process_key_shared(key, start_year=1840, end_year=2001, engine='bytes'):
+    """ Like `process_key`, but the rows are written in the shared matrix instead of a pickle.
+    The rows are reserved once the key is parsed; the words are returned with the offset of their rows """
+    matrix, next_row = shared_counts
+    hits, misses = cache_stats()
+    word_counts  = PARSE_ENGINES[engine](key, start_year, end_year)
+
+    with next_row.get_lock():
+        offset = next_row.value
+        if offset + len(word_counts) > matrix.shape[0]:
+            # retrying won't help, so don't raise
+            return "Shared matrix full ({} rows), can't add {} words of {}".format(
+                matrix.shape[0], len(word_counts), key.name)
+        next_row.value = offset + len(word_counts)
+
+    for i, counts in enumerate(word_counts.values()):
+        matrix[offset + i] = counts
+
+    key_hits, key_misses = cache_stats()
+    return key, len(word_counts), key_hits - hits, key_misses - misses, list(word_counts.keys()), offset
+
+
+def backoff_delay(attempt, base=1, cap=60):
+    """ Exponential backoff with jitter: up to `base * 2**attempt` seconds (capped), at least half of it,
+    so that workers failing together don't retry together """
+    delay = min(cap, base * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def retry(func, *args, **kw_args):
     """ Stupid workaround because MP doesn't support decorators
-    Retries `process_key` for 5 times """
+    Retries `func` for 5 times """
     num_tries = 5
-    while num_tries:
+    for attempt in range(num_tries):
         try:
-            num_tries -= 1
-            return process_key(*args, **kw_args)
+            return func(*args, **kw_args)
         except Exception as e:
-            # this is usually a timeout exception. The resource could be busy, so wait a bit
-            time.sleep(1)
-            if not num_tries:
+            if attempt == num_tries - 1:
                 # we return the exception, so that it can be logged
                 return str(e)
-    return "Nothing"
+            # this is usually a timeout exception. The resource could be busy, so wait a bit
+            time.sleep(backoff_delay(attempt))
+
+
+def retry_process_key(*args, **kw_args):
+    return retry(process_key, *args, **kw_args)
+
+
+def retry_process_key_shared(*args, **kw_args):
+    return retry(process_key_shared, *args, **kw_args)
 
 
 # this belongs to global thread
 log_file = None
 start_time = 0
 num_keys, num_kbytes, num_words = 0, 0, 0
+num_hits, num_misses = 0, 0
 def logger(res):
-    global log_file, start_time, num_keys, num_kbytes, num_words
+    global log_file, start_time, num_keys, num_kbytes, num_words, num_hits, num_misses
 
     if type(res) is str:
         # it was an error
@@ -156,63 +601,122 @@ def logger(res):
 
     time_sofar = int(time.time() - start_time)
 
-    key, key_words = res
+    key, key_words, key_hits, key_misses = res
     print(key_basename(key), flush=True)
 
     num_keys   += 1
     num_kbytes += key.size >> 10
     num_words  += key_words
+    num_hits   += key_hits
+    num_misses += key_misses
 
     print("{info} Key {kn} finished. Elapsed: {total}s ({avg} s/key, {b} kbytes/s)"
-          " {w} words in {k} keys.".format(
+          " {w} words in {k} keys. Cleaning cache: {h} hits, {m} misses ({r:.1%})".format(
               info = datetime.now(), kn = key_basename(key), total = time_sofar,
               avg=time_sofar // num_keys, b = num_kbytes // time_sofar,
-              w=num_words, k=num_keys), file=log_file, flush=True)
+              w=num_words, k=num_keys, h=num_hits, m=num_misses,
+              r=num_hits / max(num_hits + num_misses, 1)), file=log_file, flush=True)
+
 
+shared_rows = []
+def shared_logger(res):
+    """ Keeps the words and row offset reported by `process_key_shared`, then logs as usual """
+    if type(res) is not str:
+        shared_rows.append(res[4:])
+        res = res[:4]
+    logger(res)
 
-def aggregate(lang, n, start_year, end_year):
-    """ Downloads filtered aggregates for given years and n """
+
+def iter_keys(bucket, lang, n):
+    """ The keys of interest for (lang, n), largest first so that the longest ones don't end up last """
+    prefix = build_prefix(lang, n)
+    for key in sorted(bucket.list(prefix, '-'), key=lambda k: k.size, reverse=True):
+        # skip uninteresting files; including "a_"
+        name = key_basename(key)
+        if not name.isalpha() or name in ['other', 'pos', 'punctuation']:
+            continue
+        yield key
+
+
+def prepare_root(lang, n, start_year, end_year):
+    """ Returns the folder where the aggregates are saved, after asking to create it if needed.
+    Returns None if the user refuses """
     year_str  = 'y{}-{}'.format(start_year, end_year)
     root_path = os.path.join('/mnt/cluster-nas/ciprian/n-grams/', lang, year_str, str(n))
 
-    num_files = len(glob.glob(root_path + '/*.pkl'))
-    if n == 1 and num_files == 26 or num_files == 26**2:
-        print('Data exists at ', root_path)
-        return
-
     if not os.path.exists(root_path):
         ans = 'm'
         while ans not in 'yn' or len(ans) != 1:
             ans = input('Create directory ' + root_path + ' ? (y/n)')
         if ans == 'n':
-            return
+            return None
 
         os.makedirs(root_path, exist_ok=True)
+    return root_path
+
+
+def pending_keys(bucket, lang, n, root_path, verify=False):
+    """ The (key, save_path) still to process, largest first: those without a matching manifest """
+    keys = []
+    for key in iter_keys(bucket, lang, n):
+        name = key_basename(key)
+        key_path = os.path.join(root_path, name + '.pkl')
+        if is_complete(key_path, key, verify):
+            print("Exists", name, file=log_file, flush=True)
+            continue
+        keys.append((key, key_path))
+    return keys
+
+
+def aggregate(lang, n, start_year, end_year, engine='bytes', verify=False, split_size=None, scratch_dir='/tmp',
+              metrics_path=None):
+    """ Downloads filtered aggregates for given years and n. `engine` is passed on to `process_key`
+
+    Only the keys without a matching manifest are processed: missing ones, those that changed in the bucket
+    (size or etag) and those whose output doesn't match its manifest. With `verify=True` the outputs are
+    checksummed as well, which reads them all back.
+
+    Keys of at least `split_size` bytes are processed first, one at a time with `process_large_key`,
+    so that they don't make the long tail of the job.
 
+    With `metrics_path`, the workers send their counters (lines parsed, bytes decompressed, words kept,
+    time in regex, parsing and waiting for the network) to a listener process, which writes them there as
+    JSON lines and prints a summary regularly. """
+    root_path = prepare_root(lang, n, start_year, end_year)
+    if root_path is None:
+        return
 
     global log_file, start_time
 
     bucket = get_s3_bucket()
-    prefix = build_prefix(lang, n)
     log_file = open("{l}{n}{date:%m-%d-%H-%M}.log".format(l=lang, n=n, date=datetime.now()), "a")
 
-    # paralellism
-    pool = mp.Pool(20)
     start_time = time.time() - 1 # to avoid 0 time
 
-    # map them out
-    for key in sorted(bucket.list(prefix, '-'), key=lambda k: k.size, reverse=True):
-        # skip uninteresting files; including "a_"
-        name = key_basename(key)
-        if not name.isalpha() or name in ['other', 'pos', 'punctuation']:
-            continue
+    keys = pending_keys(bucket, lang, n, root_path, verify)
 
-        key_path = os.path.join(root_path, name + '.pkl')
-        if os.path.exists(key_path):
-            print("Exists", name, file=log_file, flush=True)
-            continue
+    # setup the metrics listener, before the largest keys since they matter the most
+    initializer, listener, metrics_queue = None, None, None
+    if metrics_path:
+        metrics_queue = mp.Queue(-1)
+        listener = mp.Process(target=metrics.log_listener, args=(metrics_queue, metrics_path))
+        listener.start()
+        initializer = partial(metrics.init_metrics, metrics_queue)
+        # this process also decompresses the largest keys
+        metrics.init_metrics(metrics_queue)
+
+    # the largest keys, each split among all the CPUs
+    while split_size and keys and keys[0][0].size >= split_size:
+        key, key_path = keys.pop(0)
+        logger(retry(process_large_key, key, key_path, start_year, end_year, scratch_dir,
+                     metrics_queue=metrics_queue))
+
+    # paralellism
+    pool = mp.Pool(20, initializer=initializer)
 
-        pool.apply_async(retry_process_key, (key, key_path, start_year, end_year), callback=logger)
+    # map them out
+    for key, key_path in keys:
+        pool.apply_async(retry_process_key, (key, key_path, start_year, end_year, engine), callback=logger)
 
     # no more tasks
     pool.close()
@@ -221,6 +725,83 @@ def aggregate(lang, n, start_year, end_year):
     pool.join()
     log_file.close()
 
+    if listener is not None:
+        metrics_queue.put(None)
+        listener.join()
+
+
+@numba.jit(nopython=True)
+def _nmb_merge_sorted_rows(mat, starts):
+    """ Sums in place the rows of `mat` from `starts[i]` to `starts[i + 1]` into row `i`. Rows only move up,
+    so the groups still to merge are never overwritten """
+    num_rows = mat.shape[0]
+    for i in range(len(starts)):
+        end = starts[i + 1] if i + 1 < len(starts) else num_rows
+        total = mat[starts[i]].copy()
+        for j in range(starts[i] + 1, end):
+            total += mat[j]
+        mat[i] = total
+
+
+def aggregate_shared(lang, n, start_year, end_year, max_words=2**24, engine='bytes'):
+    """ Downloads filtered aggregates for given years and n straight into memory, without going through disk.
+
+    The workers write their rows in a shared memory matrix of `max_words` rows, at offsets they reserve once
+    a key is parsed; the words come back to the parent, which then sorts the rows in place and adds up
+    those of the words found in several keys, as `utils.pickles_to_columnar` does.
+    Returns a `ColumnarCounts`, e.g. for `chronocloud_final.go(..., word_counts=)`.
+    Nothing is saved: use `aggregate` for resumable runs.
+
+    The matrix takes `max_words * (end_year - start_year) * 4` bytes of shared memory, e.g. 10.8 GB for the
+    default 2**24 rows over 1840-2001. Only the pages used are actually allocated, but /dev/shm must be
+    large enough for the whole of it. Keys that don't fit anymore are reported in the log, not aggregated:
+    give a larger `max_words` then. """
+    global log_file, start_time, shared_rows
+
+    range_size = end_year - start_year
+    shm = shared_memory.SharedMemory(create=True, size=max_words * range_size * np.dtype(np.uint32).itemsize)
+    next_row = mp.Value('q', 0)
+    shared_rows = []
+
+    bucket = get_s3_bucket()
+    log_file = open("{l}{n}{date:%m-%d-%H-%M}-shared.log".format(l=lang, n=n, date=datetime.now()), "a")
+
+    pool = mp.Pool(20, initializer=init_shared_worker, initargs=(shm.name, (max_words, range_size), next_row))
+    start_time = time.time() - 1 # to avoid 0 time
+
+    for key in iter_keys(bucket, lang, n):
+        pool.apply_async(retry_process_key_shared, (key, start_year, end_year, engine), callback=shared_logger)
+
+    pool.close()
+    pool.join()
+    log_file.close()
+
+    # the memory is released once the parent closes it as well
+    shm.unlink()
+
+    # rows reserved by a failed write have no word, they are moved after the used ones
+    num_rows = next_row.value
+    vocab  = np.empty(num_rows, dtype=object)
+    filled = np.zeros(num_rows, dtype=bool)
+    for words, offset in shared_rows:
+        vocab[offset:offset + len(words)]  = words
+        filled[offset:offset + len(words)] = True
+    rows = np.flatnonzero(filled)
+    vocab = vocab[rows].astype(str)
+
+    counts = np.ndarray((max_words, range_size), dtype=np.uint32, buffer=shm.buf)[:num_rows]
+    order  = np.concatenate([rows[np.argsort(vocab, kind='stable')], np.flatnonzero(~filled)])
+    _nmb_permute_rows(counts, order)
+
+    # a word can come from several keys, e.g. after `.lower()`: its rows are now next to each other
+    vocab, starts = np.unique(vocab, return_index=True)
+    if len(vocab) < len(rows):
+        _nmb_merge_sorted_rows(counts[:len(rows)], starts)
+
+    store = ColumnarCounts(vocab, counts[:len(vocab)], start_year)
+    store.shm = shm  # the rows are a view on the shared memory, which must stay open
+    return store
+
 
 if __name__ == "__main__":
     if len(sys.argv) != 5:
@@ -0,0 +1,269 @@
+import os, sys, glob, time
+import numpy as np
+import pandas as pd
+from functools import cached_property
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from corpus import Corpus
+from utils import counts_folder, load_google_counts, normalize_counts, resilience_table, ColumnarCounts
+from distances import cached_distances, pack_presence
+
+
+START_YEAR, END_YEAR = 1800, 2012
+LAST_YEAR = 2008              # the notebooks drop 2009 -> 2012
+RESILIENCE_THRES  = 0.1       # `resilience_thres` of Words_analysis.ipynb
+KERNEL_RESILIENCE = 200       # `kernel_resilience` of Draw_measure.ipynb
+SPECTRUM_RES = (64, 75, 90, 137, 139)
+EVENT_YEARS  = (1850, 1950)
+
+# rough memory of a target besides its memory-mapped counts: what is kept per word (vocabulary, resilience
+# table, totals, presence bits) and the chunks being read. The per-key pickles are all loaded in a dict
+BYTES_PER_WORD = 128
+CHUNK_MEMORY   = 2**16 * (END_YEAR - START_YEAR) * 8 * 4
+PICKLE_FACTOR  = 4
+
+
+class TargetData:
+    """ The data of one (lang, n) shared by all the stages. The counts are loaded once, memory-mapped if they
+    are in a columnar store, and only ever read by chunks: what is derived from them (yearly totals,
+    resiliences, frequencies, kernel ranks, distances) is computed the first time a stage needs it.
+    The frequencies are memory-mapped as well, in `work_dir` """
+    def __init__(self, lang, n, out_dir='out_files', figures_dir='figures', work_dir='batch_cache', resolution=3000):
+        self.lang = lang
+        self.n    = n
+        self.out_dir     = out_dir
+        self.figures_dir = figures_dir
+        self.work_dir    = work_dir
+        self.resolution  = resolution
+
+    def out_path(self, kind, ext='csv', folder=None):
+        """ e.g. `out_files/eng-1-words-1850.csv` for `kind='words-1850'` """
+        return os.path.join(folder or self.out_dir, '{l}-{n}-{k}.{e}'.format(l=self.lang, n=self.n, k=kind, e=ext))
+
+    @cached_property
+    def store(self):
+        store = load_google_counts(self.lang, self.n, START_YEAR, END_YEAR)
+        if isinstance(store, dict):     # the per-key pickles, not converted to a columnar store yet
+            vocab = np.array(sorted(store))
+            store = ColumnarCounts(vocab, np.array([store[word] for word in vocab]), START_YEAR)
+        return store
+
+    @cached_property
+    def year_totals(self):
+        return sum(counts.sum(axis=0, dtype=np.uint64) for _, counts in self.store.iter_chunks())
+
+    @cached_property
+    def corpus(self):
+        """ The years of the notebooks: up to `LAST_YEAR`, without the empty ones, like `get_filtered_df` """
+        years = np.arange(START_YEAR, END_YEAR)
+        return Corpus('google', START_YEAR, END_YEAR, excluded=years[(years > LAST_YEAR) | (self.year_totals == 0)])
+
+    @cached_property
+    def table(self):
+        """ `resilience_table` of the counts over the years of `corpus`, in the order of `store.vocab` """
+        return resilience_table(self.store, START_YEAR, self.year_totals, RESILIENCE_THRES, corpus=self.corpus)
+
+    @cached_property
+    def ress(self):
+        """ The `df_new_resilience` of Words_analysis.ipynb: longest run of years where each word is really
+        alive (`res`, from `start` to `end` included) """
+        ress = pd.DataFrame({'res': self.table['alive_res'], 'start': self.table['birth'], 'end': self.table['death']},
+                            index=self.store.vocab)
+        return ress if ress.index.is_monotonic_increasing else ress.sort_index()
+
+    @cached_property
+    def word_totals(self):
+        """ Total count of each word over the years of `corpus` """
+        mask = self.corpus.mask
+        totals = [counts[:, mask].sum(axis=1, dtype=np.uint64) for _, counts in self.store.iter_chunks()]
+        return pd.Series(np.concatenate(totals), index=self.store.vocab)
+
+    @cached_property
+    def freqs(self):
+        """ The frequencies of `normalize_counts`, memory-mapped in `work_dir` """
+        os.makedirs(self.work_dir, exist_ok=True)
+        out_path = os.path.join(self.work_dir, '{l}-{n}-freqs.npy'.format(l=self.lang, n=self.n))
+        freqs, _ranks = normalize_counts(self.store, corpus=self.corpus, dtype=np.float64, out_path=out_path)
+        return freqs
+
+    @cached_property
+    def kernel_ranks(self):
+        """ Ranks of the words more resilient than `KERNEL_RESILIENCE`, among themselves, with years as rows.
+        Only their rows of the frequencies are read """
+        words = np.sort(self.store.vocab[self.table['res'] > KERNEL_RESILIENCE])
+        rows  = np.searchsorted(self.freqs.vocab, words)
+        kernel = pd.DataFrame(self.freqs.counts[rows].T, index=self.freqs.years, columns=words)
+        return kernel.rank(axis='columns', method='first')
+
+    @cached_property
+    def jaccard(self):
+        mask = self.corpus.mask
+        presence = pack_presence((counts[:, mask] for _, counts in self.store.iter_chunks()), self.corpus.kept_years())
+        return cached_distances('packed_jaccard', presence, self.lang, self.n, 'all')
+
+    @cached_property
+    def kernel(self):
+        # same cache as the kernel ranked among itself in Draw_measure.ipynb
+        return cached_distances('kernel', self.kernel_ranks, self.lang, self.n,
+                                'res{}-rank-kernel'.format(KERNEL_RESILIENCE))
+
+
+# ---------------------------------------------------------------------------------------------------- stages
+
+
+def births_deaths(data):
+    """ The words born (`words-Y`) and dead (`deaths-Y`) in each of `EVENT_YEARS` """
+    ress = data.ress
+    for year in EVENT_YEARS:
+        ress[ress.start == year].to_csv(data.out_path('words-%d' % year))
+        ress[ress.end == year].to_csv(data.out_path('deaths-%d' % year))
+
+
+def spectrum(data):
+    """ Total count of the words of each resilience of `SPECTRUM_RES`, most used first """
+    ress = data.ress
+    for r in SPECTRUM_RES:
+        words = ress.index[ress.res == r]
+        data.word_totals[words].sort_values(ascending=False).to_csv(data.out_path('spectrum-%d' % r))
+
+
+def distances(data):
+    """ Jaccard distances between the years, and kernel distances between the ranks of the kernel.
+    They are cached on disk, see `distances.cached_distances` """
+    data.jaccard
+    data.kernel
+
+
+def stability(data):
+    """ The words of the kernel whose rank varies the least and the most """
+    k_var = data.kernel_ranks.var(axis='rows').sort_values()
+    k_var.tail(100).to_csv(data.out_path('least'))
+    with open(data.out_path('stable', 'txt'), 'w') as f:
+        print(k_var.head(20), file=f)  # 20 most  stable
+        print(k_var.tail(20), file=f)  # 20 least stable
+
+
+def _dist_vs_time(d):
+    """ The `get_dist_vs_time` of Draw_measure.ipynb: melts an upper triangular DataFrame for plotting """
+    r = d.reset_index().rename(columns={'index': 'year_src'})
+    r = pd.melt(r, id_vars='year_src', var_name='year_dst', value_name='distance').dropna()
+    r['time_diff'] = r.year_dst - r.year_src
+    return r
+
+
+def figures(data):
+    """ Distances versus time difference, as `jac-td` and `ker-td` of Draw_measure.ipynb """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    n = np.arange(len(data.kernel_ranks.columns))
+    kernel = data.kernel / np.abs(n - n[::-1]).sum()
+    for kind, name, dist in [('jac', 'Jaccard', data.jaccard), ('ker', 'Kernel', kernel)]:
+        dplot = _dist_vs_time(dist)
+        plt.figure(figsize=(15, 9))
+        plt.ylim(0, 1)
+        plt.title('Variation of {d} distance versus time difference\n({l}, {n}-grams)'.format(d=name, l=data.lang, n=data.n))
+        sc = plt.scatter(dplot.time_diff, dplot.distance, s=1, c=dplot.year_src, cmap='cool')
+        dplot.groupby('time_diff').distance.mean().plot(linewidth=3)
+        plt.colorbar(sc)
+        plt.savefig(data.out_path(kind + '-td', 'jpg', data.figures_dir))
+        plt.close()
+
+
+def chronocloud(data):
+    """ The chronocloud of `data.resolution` px, from the counts already loaded """
+    from chronocloud_final import go
+    go(data.lang, data.n, data.resolution, word_counts=data.store)
+
+
+# in the order they run. Each one takes a `TargetData`
+STAGES = {'births_deaths': births_deaths, 'spectrum': spectrum, 'distances': distances,
+          'stability': stability, 'figures': figures, 'chronocloud': chronocloud}
+
+
+# ---------------------------------------------------------------------------------------------------- runner
+
+
+def estimate_memory(lang, n):
+    """ Rough peak memory, in bytes, of running the stages of (lang, n): per word of its vocabulary on top
+    of the chunks being read, since the counts and the frequencies are memory-mapped """
+    folder = counts_folder(lang, n, START_YEAR, END_YEAR)
+    vocab_files = [os.path.join(folder, name + '.npy') for name in ['vocab', 'sparse_vocab']]
+    vocabs = [np.load(file, mmap_mode='r') for file in vocab_files if os.path.exists(file)]
+    if not vocabs:
+        return PICKLE_FACTOR * sum(os.path.getsize(file) for file in glob.glob(os.path.join(folder, '*.pkl')))
+    return CHUNK_MEMORY + sum(len(vocab) * (BYTES_PER_WORD + 2 * vocab.itemsize) for vocab in vocabs)
+
+
+def run_target(lang, n, stages=None, **kwargs):
+    """ Runs `stages` (names of `STAGES`, all of them by default) on (lang, n), loading it only once.
+    `kwargs` go to `TargetData`. Returns the duration of each stage """
+    stages = check_stages(stages)
+    data = TargetData(lang, n, **kwargs)
+    durations = {}
+    for name in stages:
+        start = time.time()
+        STAGES[name](data)
+        durations[name] = round(time.time() - start, 1)
+        print('{l} {n}: {s} done / {t}s'.format(l=lang, n=n, s=name, t=durations[name]), flush=True)
+    return durations
+
+
+def check_stages(stages):
+    """ `stages` in the order of `STAGES` """
+    if stages is None:
+        return list(STAGES)
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError('Unknown stages %s, expected some of %s' % (', '.join(sorted(unknown)), ', '.join(STAGES)))
+    return [name for name in STAGES if name in stages]
+
+
+def run_batch(targets, stages=None, memory_budget=None, workers=None, **kwargs):
+    """ Runs `stages` on each (lang, n) of `targets`, in `workers` processes if given.
+
+    A target is only started if the estimated memory of the running ones (see `estimate_memory`) stays below
+    `memory_budget` bytes; one that doesn't fit even alone runs when nothing else does. The largest targets
+    start first and the small ones fill the gaps. Returns the durations of `run_target` by target """
+    stages  = check_stages(stages)
+    targets = list(dict.fromkeys((lang, int(n)) for lang, n in targets))
+    if not (workers and workers > 1):
+        return {target: run_target(*target, stages, **kwargs) for target in targets}
+
+    estimates = {target: estimate_memory(*target) for target in targets}
+    pending = sorted(targets, key=estimates.get, reverse=True)
+    results, running = {}, {}
+    with ProcessPoolExecutor(workers) as executor:
+        while pending or running:
+            used = sum(estimates[target] for target in running.values())
+            for target in list(pending):
+                if len(running) == workers:
+                    break
+                if running and memory_budget is not None and used + estimates[target] > memory_budget:
+                    continue
+                running[executor.submit(run_target, *target, stages, **kwargs)] = target
+                used += estimates[target]
+                pending.remove(target)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return results
+
+
+def physical_memory():
+    return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python batch.py lang-n[,lang-n...] [stage,stage...|all] [memory_gb] [workers]')
+        print('Stages: ' + ', '.join(STAGES))
+        sys.exit()
+
+    targets = [target.split('-') for target in sys.argv[1].split(',')]
+    stages  = None if len(sys.argv) < 3 or sys.argv[2] == 'all' else sys.argv[2].split(',')
+    memory_budget = float(sys.argv[3]) * 2**30 if len(sys.argv) > 3 else 0.8 * physical_memory()
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else min(len(targets), os.cpu_count())
+    run_batch(targets, stages, memory_budget, workers)
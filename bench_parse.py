@@ -0,0 +1,40 @@
+import sys, time
+from functools import partial
+from itertools import islice
+
+from agg_download import PARSE_ENGINES
+
+
+def read_chunks(file_path, chunk_size=8192):
+    """ Iterates over a local gzipped shard in chunks, like iterating over an S3 key does """
+    with open(file_path, 'rb') as f:
+        for chunk in iter(partial(f.read, chunk_size), b''):
+            yield chunk
+
+
+def main(file_path, start_year=1840, end_year=2001):
+    """ Times each parse engine on a local sample shard and checks they give identical counts """
+    # warm up on the first chunks, so that numba compilation is not timed
+    for count in PARSE_ENGINES.values():
+        count(islice(read_chunks(file_path), 16), start_year, end_year)
+
+    results = {}
+    for name, count in PARSE_ENGINES.items():
+        start = time.time()
+        results[name] = count(read_chunks(file_path), start_year, end_year)
+        print('{e:>6}: {t:.2f}s, {w} words'.format(e=name, t=time.time() - start, w=len(results[name])))
+
+    reference = results.pop('str')
+    for name, word_counts in results.items():
+        assert word_counts.keys() == reference.keys(), name + ' gives different words'
+        for word, counts in reference.items():
+            assert counts.dtype == word_counts[word].dtype and (counts == word_counts[word]).all(), \
+                name + ' gives different counts for ' + word
+    print('All engines agree')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 4):
+        print('Usage: python bench_parse.py shard.gz [start_year end_year]')
+        sys.exit()
+    main(sys.argv[1], *map(int, sys.argv[2:]))
@@ -5,11 +5,17 @@ import glob
 import pickle
 import numpy as np
 from datetime import datetime
-from functools import partial
+from functools import partial, lru_cache
+from concurrent.futures import ProcessPoolExecutor
 from wordcloud import WordCloud
 from PIL import Image, ImageFont, ImageDraw
 from os import path
 
+from corpus import get_corpus
+from features import feature_index, compute_features, words_carac_from_features, sector_words
+from tiles import render_tiled, text_size
+from layout_format import save_layout
+
 
 def image_from_np(matrix):
     w = matrix.shape[0]
@@ -54,7 +60,7 @@ def generate_date_circle(matrix, dates, angles, pos_dep):
         the_text = dates[i]
         image = Image.new('RGB', (n, n), (0, 0, 0))
         draw = ImageDraw.Draw(image)
-        w, h = draw.textsize(the_text, the_font)
+        w, h = text_size(the_font, the_text)
         pos_x = int(0.5 * n - 0.5 * w)
         pos_y = int((1.0 - pos_dep) * 0.5 * n - 0.5 * h)
         draw.text((pos_x, pos_y), the_text, (255, 255, 255), the_font)
@@ -76,7 +82,11 @@ def extract_frequency(frequencies):
     return frequencies.sum()
 
 
-def extract_resilience(frequencies):
+def extract_resilience(frequencies, corpus=None, years=None):
+    """ longest run of years with the word. The excluded years of `corpus` are skipped, `years` being
+    the year of each value (by default those of the corpus) """
+    if corpus is not None:
+        frequencies = get_corpus(corpus).kept(frequencies, years)
     resilience, res_max = 0, 0
     for freq in frequencies:
         if freq != 0.0:
@@ -92,14 +102,164 @@ def color_func(colors, word, font_size, position, orientation, random_state=None
     return colors[word]
 
 
-def make_chronocloud(words_carac, n, name, langage):
-    data = np.zeros((n, n, 3), dtype=np.uint8)
+# edges of the 16 sectors, one per decade
+T  = 0.002         # taux ligne
+P1 = 2.41421356237
+P2 = 0.41421356237
+#modele : Z1 (x - Z2 * a) + Z3 (y - Z4 * b) > 0
+ARRETES = [
+    [[- 1, 1+T,  0, 1  ],    [ P1, 1  ,  1, 1  ]],
+    [[-P1, 1  , -1, 1  ],    [  1, 1  ,  1, 1  ]],
+    [[- 1, 1  , -1, 1  ],    [ P2, 1  ,  1, 1  ]],
+    [[-P2, 1  , -1, 1  ],    [  0, 1  ,  1, 1-T]],
+    [[  0, 1  , -1, 1+T],    [-P2, 1  ,  1, 1  ]],
+    [[ P2, 1  , -1, 1  ],    [- 1, 1  ,  1, 1  ]],
+    [[  1, 1  , -1, 1  ],    [-P1, 1  ,  1, 1  ]],
+    [[ P1, 1  , -1, 1  ],    [- 1, 1+T,  0, 1  ]],
+    [[  1, 1-T,  0, 1  ],    [-P1, 1  , -1, 1  ]],
+    [[ P1, 1  ,  1, 1  ],    [- 1, 1  , -1, 1  ]],
+    [[  1, 1  ,  1, 1  ],    [-P2, 1  , -1, 1  ]],
+    [[ P2, 1  ,  1, 1  ],    [  0, 1  , -1, 1+T]],
+    [[  0, 1  ,  1, 1-T],    [ P2, 1  , -1, 1  ]],
+    [[-P2, 1  ,  1, 1  ],    [  1, 1  , -1, 1  ]],
+    [[- 1, 1  ,  1, 1  ],    [ P1, 1  , -1, 1  ]],
+    [[-P1, 1  ,  1, 1  ],    [  1, 1-T,  0, 1  ]],
+]
+
+
+def _radii(n, resilience):
+    """ Outer and inner radius of the ring of `resilience` """
+    r_1 = 0.45 * (7 - (resilience / 25)) * (n / 5)
+    r_2 = 0.45 * (6 - (resilience / 25)) * (n / 5)
+    return r_1, r_2
+
+
+def _cell_mask(n, resilience, years_lim, rows, cols):
+    """ The mask of the cell (resilience, years_lim), evaluated only on the pixels of the [rows] x [cols] box.
+    Same conditions as on the full image, so the pixels are exactly the same """
+    a, b = n / 2, n / 2
+    y, x = np.ogrid[rows[0]:rows[1] + 1, cols[0]:cols[1] + 1]
+    r_1, r_2 = _radii(n, resilience)
+    the_mask = np.zeros((rows[1] - rows[0] + 1, cols[1] - cols[0] + 1), dtype=np.uint8)
+    if years_lim is None:
+        condition = (x - a) * (x - a) + (y - b) * (y - b) > r_1 * r_1
+        the_mask[condition] = 255
+    else:
+        condition_1 = (x - a) * (x - a) + (y - b) * (y - b) > r_1 * r_1
+        condition_2 = (x - a) * (x - a) + (y - b) * (y - b) < r_2 * r_2
+
+        indice = (years_lim - 1840) // 10
+        z1, z2, z3, z4 = ARRETES[indice][0]
+        condition_3 = z1 * (x - z2 * a) + z3 * (y - z4 * b) > 0
+        z1, z2, z3, z4 = ARRETES[indice][1]
+        condition_4 = z1 * (x - z2 * a) + z3 * (y - z4 * b) > 0
+
+        the_mask[condition_1 | condition_2 | condition_3 | condition_4] = 255
+    return the_mask
+
+
+def _cell_box(n, resilience, years_lim, pad=2):
+    """ Bounding box (rows, cols) of the cell (resilience, years_lim) from its geometry, padded by `pad`
+    pixels against rounding. The extremes of a ring sector are at its corners (where the circles and the
+    edges cross) or where a circle is tangent to the box, whichever of these are inside the sector """
+    a, b = n / 2, n / 2
+    r_1, r_2 = _radii(n, resilience)
+    if years_lim is None:
+        r_2, lines = 0, []
+    else:
+        indice = (years_lim - 1840) // 10
+        # z1 (x - z2 a) + z3 (y - z4 b) <= 0 inside, i.e. z1 x + z3 y <= c
+        lines = [(z1, z3, z1 * z2 * a + z3 * z4 * b) for z1, z2, z3, z4 in ARRETES[indice]]
+
+    points = [(a + dx * r, b + dy * r) for r in (r_1, r_2) for dx, dy in [(1, 0), (-1, 0), (0, 1), (0, -1)]]
+    for z1, z3, c in lines:
+        norm = np.hypot(z1, z3)
+        dist = (c - z1 * a - z3 * b) / norm                  # signed distance from the center
+        foot = (a + dist * z1 / norm, b + dist * z3 / norm)
+        for r in (r_1, r_2):
+            if abs(dist) <= r:
+                half = np.sqrt(r * r - dist * dist)
+                points += [(foot[0] - s * half * z3 / norm, foot[1] + s * half * z1 / norm) for s in (-1, 1)]
+    if len(lines) == 2:
+        (z1, z3, c), (w1, w3, d) = lines
+        det = z1 * w3 - z3 * w1
+        if det:
+            points.append(((c * w3 - z3 * d) / det, (z1 * d - c * w1) / det))
+
+    eps = 1e-6 * n
+    inside = [(x, y) for x, y in points
+              if r_2 - eps <= np.hypot(x - a, y - b) <= r_1 + eps
+              and all(z1 * x + z3 * y <= c + eps for z1, z3, c in lines)]
+    xs, ys = [x for x, _ in inside], [y for _, y in inside]
+    rows = (max(int(np.floor(min(ys))) - pad, 0), min(int(np.ceil(max(ys))) + pad, n - 1))
+    cols = (max(int(np.floor(min(xs))) - pad, 0), min(int(np.ceil(max(xs))) + pad, n - 1))
+    return rows, cols
+
+
+@lru_cache(maxsize=None)
+def sector_bounds(n, resilience, years_lim=None):
+    """ Exact bounding rectangle `(x_min, x_max, y_min, y_max)` of the pixels of the cell (resilience, years_lim)
+    of a chronocloud of size `n`. As in the layout, `x` is the row and `y` the column.
+    Only the box given by the geometry is evaluated, and the result is kept for later renders of the same size
+    by the process computing it: `make_chronocloud` calls it, through `sector_mask`, before its pool """
+    rows, cols = _cell_box(n, resilience, years_lim)
+    inside = _cell_mask(n, resilience, years_lim, rows, cols) == 0
+    in_rows, in_cols = np.flatnonzero(inside.any(axis=1)), np.flatnonzero(inside.any(axis=0))
+    return (rows[0] + int(in_rows[0]), rows[0] + int(in_rows[-1]),
+            cols[0] + int(in_cols[0]), cols[0] + int(in_cols[-1]))
+
+
+@lru_cache(maxsize=65)  # the 65 cells of the last size rendered
+def sector_mask(n, resilience, years_lim=None):
+    """ Mask of the cell (resilience, years_lim) of a chronocloud of size `n`, 0 inside and 255 outside,
+    cropped to its bounding rectangle. `years_lim=None` gives the center, a disc of radius r_1.
+    Returns (mask, x_min, y_min), the offset of the rectangle in the full image. The mask is cached,
+    hence read-only """
+    x_min, x_max, y_min, y_max = sector_bounds(n, resilience, years_lim)
+    the_mask = _cell_mask(n, resilience, years_lim, (x_min, x_max), (y_min, y_max))
+    the_mask.flags.writeable = False
+    return the_mask, x_min, y_min
+
+
+def layout_sector(the_real_mask, x_min, y_min, the_words, the_colors, wc_params, random_state=None):
+    """ Lays out `the_words` in the cell whose mask is `the_real_mask`, at (x_min, y_min) in the full image,
+    see `sector_mask`. Returns the `words_` and `layout_` of the cloud, with positions in the full image """
+    wc = WordCloud(
+        mask=the_real_mask,
+        color_func=partial(color_func, the_colors),
+        random_state=random_state,
+        **wc_params
+    )
+    wc.generate_from_frequencies(the_words)
+
+    # extract data; need to expand the layout in order to add x_min, y_min
+    layout = [(word, font_size, (position[0] + x_min, position[1] + y_min), orientation, color)
+              for word, font_size, position, orientation, color in wc.layout_]
+    return wc.words_, layout
+
+
+def _layout_sector_task(args):
+    return layout_sector(*args)
+
+
+def make_chronocloud(words_carac, n, name, langage, workers=None, seed=None, strip_rows=None):
+    """ Renders the chronocloud of `words_carac` (see `features.words_carac_from_features`) in an `n` px image.
+
+    The center and the 64 sectors are laid out independently, in `workers` processes if given. Their masks
+    are computed here and sent to the workers, so they are reused by later calls at the same `n`.
+    They are merged in the same order either way, so with a `seed` the result does not depend
+    on `workers`: the cell `i` of that order always uses `random_state=seed + i`.
+
+    With `strip_rows`, the image is drawn and written `strip_rows` rows at a time (see `tiles.render_tiled`)
+    instead of as a whole, which is needed for the largest sizes """
     dates = [str(year) for year in range(1840, 1991, 10)]
     dates[0] = '2000 | ' + dates[0]
     angles = [0, 337.5, 315.0, 292.5, 270.0, 247.5, 225.0, 202.5, 180.0, 157.5, 135.0, 112.5, 90.0, 67.5, 45.0, 22.5]
-    data = generate_date_circle(data, dates, angles, 0.95)
-    data = 255 - data
-    print('chronocloud legend: done')
+    if not strip_rows:
+        data = np.zeros((n, n, 3), dtype=np.uint8)
+        data = generate_date_circle(data, dates, angles, 0.95)
+        data = 255 - data
+        print('chronocloud legend: done')
     if langage == 'Hebrew':
         the_font = 'NotoSansHebrew-Regular.ttf'
     elif langage == 'Chinese_simplified':
@@ -107,164 +267,52 @@ def make_chronocloud(words_carac, n, name, langage):
     else:
         the_font = 'NotoSans-Regular.ttf'
 
-    # TODO: pack these in a dict `default_params` and pass as wc(..., **default_params)
-    param_max_font_size = 0.03 * n
-    param_relative_scaling = 0.5
     param_max_words = 5000
+    wc_params = dict(
+        font_path=the_font,
+        prefer_horizontal=0.5,
+        background_color='white',
+        max_words=param_max_words,
+        stopwords=[],
+        relative_scaling=0.5,
+        max_font_size=0.03 * n
+    )
+
+    # every word is put in its cell once, with only as many words as the cloud can take
+    sectors = sector_words(words_carac, param_max_words)
+
+    # the center first, then each sector[resilience, year]
+    cells = [(150, None)] + [(resilience, years_lim) for resilience in [125, 100, 75, 50]
+                                                     for years_lim in range(1840, 1991, 10)]
+    tasks = []
+    for i, (resilience, years_lim) in enumerate(cells):
+        the_words, the_colors = sectors.get((resilience, years_lim), ({}, {}))
+        if the_words:
+            random_state = None if seed is None else seed + i
+            the_mask, x_min, y_min = sector_mask(n, resilience, years_lim)
+            tasks.append((the_mask, x_min, y_min, the_words, the_colors, wc_params, random_state))
 
-    # prepare the mask for the center, which is a ring or radius r_1
-    resilience = 150  # for the center
-    r_1 = 0.45 * (7 - (resilience / 25)) * (n / 5)
-    a, b = n / 2, n / 2
-    y, x = np.ogrid[0:n, 0:n]
-    condition = (x - a) * (x - a) + (y - b) * (y - b) > r_1 * r_1
-
-    # start with full image
-    the_mask = np.zeros((n, n), dtype=np.uint8)
-    the_mask[condition] = 255
-    x_min = min(np.argwhere(the_mask == 0)[..., 0])
-    x_max = max(np.argwhere(the_mask == 0)[..., 0])
-    y_min = min(np.argwhere(the_mask == 0)[..., 1])
-    y_max = max(np.argwhere(the_mask == 0)[..., 1])
-
-    # but paint only inside the bounding rectangle of interest, because it's faster
-    the_real_mask = the_mask[x_min:(x_max + 1), y_min:(y_max + 1)]
-
-    the_words  = {}
-    the_colors = {}
-    for word in words_carac:
-        if words_carac[word][2] >= resilience:
-            the_words[word] = words_carac[word][1]
-            try:
-                the_colors[word] = words_carac[word][3]
-            except:
-                print(words_carac[word])
     var_1, var_2 = [], []
-    if the_words:                        # it has some keys
-        color_func_apply = partial(color_func, the_colors)
-        wc = WordCloud(
-            font_path=the_font,
-            mask=the_real_mask,
-            color_func=color_func_apply,
-            prefer_horizontal=0.5,
-            background_color='white',
-            max_words=param_max_words,
-            stopwords=[],
-            relative_scaling=param_relative_scaling,
-            max_font_size=param_max_font_size
-        )
-        wc.generate_from_frequencies(the_words)
-
-        # extract data; need to expand the layout in order to add x_min, y_min
-        var_1 += wc.words_
-        for i in range(len(wc.layout_)):
-            var_2.append((
-                    wc.layout_[i][0], wc.layout_[i][1],
-                    (wc.layout_[i][2][0] + x_min, wc.layout_[i][2][1] + y_min), wc.layout_[i][3], wc.layout_[i][4]
-                )
-            )
-    print('chronocloud noyau: done')
-
-    # prepare the sectors
-    t  = 0.002         # taux ligne
-    p1 = 2.41421356237
-    p2 = 0.41421356237
-    #modele : Z1 (x - Z2 * a) + Z3 (y - Z4 * b) > 0
-    c_1  = [[- 1, 1+t,  0, 1  ],    [ p1, 1  ,  1, 1  ]]
-    c_2  = [[-p1, 1  , -1, 1  ],    [  1, 1  ,  1, 1  ]]
-    c_3  = [[- 1, 1  , -1, 1  ],    [ p2, 1  ,  1, 1  ]]
-    c_4  = [[-p2, 1  , -1, 1  ],    [  0, 1  ,  1, 1-t]]
-    c_5  = [[  0, 1  , -1, 1+t],    [-p2, 1  ,  1, 1  ]]
-    c_6  = [[ p2, 1  , -1, 1  ],    [- 1, 1  ,  1, 1  ]]
-    c_7  = [[  1, 1  , -1, 1  ],    [-p1, 1  ,  1, 1  ]]
-    c_8  = [[ p1, 1  , -1, 1  ],    [- 1, 1+t,  0, 1  ]]
-    c_9  = [[  1, 1-t,  0, 1  ],    [-p1, 1  , -1, 1  ]]
-    c_10 = [[ p1, 1  ,  1, 1  ],    [- 1, 1  , -1, 1  ]]
-    c_11 = [[  1, 1  ,  1, 1  ],    [-p2, 1  , -1, 1  ]]
-    c_12 = [[ p2, 1  ,  1, 1  ],    [  0, 1  , -1, 1+t]]
-    c_13 = [[  0, 1  ,  1, 1-t],    [ p2, 1  , -1, 1  ]]
-    c_14 = [[-p2, 1  ,  1, 1  ],    [  1, 1  , -1, 1  ]]
-    c_15 = [[- 1, 1  ,  1, 1  ],    [ p1, 1  , -1, 1  ]]
-    c_16 = [[-p1, 1  ,  1, 1  ],    [  1, 1-t,  0, 1  ]]
-    arretes = [c_1, c_2, c_3, c_4, c_5, c_6, c_7, c_8, c_9, c_10, c_11, c_12, c_13, c_14, c_15, c_16]
-
-    # go through each sector[resilience, year]
-    for resilience in [125, 100, 75, 50]:
-        for years_lim in range(1840, 1991, 10):
-            r_1 = 0.45 * (7 - (resilience / 25)) * (n / 5)
-            r_2 = 0.45 * (6 - (resilience / 25)) * (n / 5)
-            condition_1 = (x - a) * (x - a) + (y - b) * (y - b) > r_1 * r_1
-            condition_2 = (x - a) * (x - a) + (y - b) * (y - b) < r_2 * r_2
-
-            indice = (years_lim - 1840) // 10
-            z1 = arretes[indice][0][0]
-            z2 = arretes[indice][0][1]
-            z3 = arretes[indice][0][2]
-            z4 = arretes[indice][0][3]
-            condition_3 = z1 * (x - z2 * a) + z3 * (y - z4 * b) > 0
-
-            z1 = arretes[indice][1][0]
-            z2 = arretes[indice][1][1]
-            z3 = arretes[indice][1][2]
-            z4 = arretes[indice][1][3]
-            condition_4 = z1 * (x - z2 * a) + z3 * (y - z4 * b) > 0
-
-            # TODO: aren't these redundant ?
-            the_mask = np.zeros((n, n), dtype=np.uint8)
-            the_mask[condition_1] = 255
-            the_mask[condition_2] = 255
-            the_mask[condition_3] = 255
-            the_mask[condition_4] = 255
-
-            x_min = min(np.argwhere(the_mask == 0)[..., 0])
-            x_max = max(np.argwhere(the_mask == 0)[..., 0])
-            y_min = min(np.argwhere(the_mask == 0)[..., 1])
-            y_max = max(np.argwhere(the_mask == 0)[..., 1])
-            the_real_mask = the_mask[x_min:(x_max + 1), y_min:(y_max + 1)]
-
-            # TODO: generate the words relevant for this (resilience, year)
-            the_words = {}
-            the_colors = {}
-            for word in words_carac:
-                if resilience <= words_carac[word][2] < resilience + 25 and \
-                   years_lim  <= words_carac[word][0] < years_lim  + 10:
-                    the_words[word]  = words_carac[word][1]
-                    the_colors[word] = words_carac[word][3]
-
-            if the_words:
-                color_func_apply = partial(color_func, the_colors)
-                wc = WordCloud(
-                    font_path=the_font,
-                    mask=the_real_mask,
-                    color_func=color_func_apply,
-                    prefer_horizontal=0.5,
-                    background_color='white',
-                    max_words=param_max_words,
-                    stopwords=[],
-                    relative_scaling=param_relative_scaling,
-                    max_font_size=param_max_font_size
-                )
-                wc.generate_from_frequencies(the_words)
-                var_1 += wc.words_
-                for i in range(len(wc.layout_)):
-                    var_2.append((
-                            wc.layout_[i][0], wc.layout_[i][1],
-                            (wc.layout_[i][2][0] + x_min, wc.layout_[i][2][1] + y_min), wc.layout_[i][3], wc.layout_[i][4]
-                        )
-                    )
-        print('chronocloud R=' + str(resilience) + ': done')
+    if workers and workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            layouts = list(executor.map(_layout_sector_task, tasks))
+    else:
+        layouts = map(_layout_sector_task, tasks)
+    for words, layout in layouts:
+        var_1 += words
+        var_2 += layout
+    print('chronocloud sectors: done')
+
+    save_layout(name + '_chronodata_layout.npz', var_2, var_1, n)
+
+    if strip_rows:
+        render_tiled(name + '_chronocloud.png', n, var_2, dates, angles, 0.95, the_font,
+                     legend_font='NotoSans-Regular.ttf', strip_rows=strip_rows)
+        return
 
     wc_montre = WordCloud(font_path=the_font, background_color='white', width=n, height=n)
     wc_montre.words_  = var_1
     wc_montre.layout_ = var_2
-    fichier = open(name + '_chronodata_words_alt.txt', 'w')
-    for i in range(len(var_1)):
-        fichier.write(str(var_1[i]) + '\n')
-    fichier.close()
-    fichier = open(name + '_chronodata_layout_alt.txt', 'w')
-    for i in range(len(var_2)):
-        fichier.write(str(var_2[i]) + '\n')
-    fichier.close()
     data_1 = 255 - data
     data_2 = 255 - wc_montre.to_array()
     data = data_1 + data_2
@@ -287,99 +335,87 @@ def est_alpha(ngram):
 
 # ----------------------------------------------------------------------------------------------------
 
-def freqs_from_counts(word_counts):
-    some_value = next(iter(word_counts.values()))
-    year_counts = np.zeros(len(some_value), dtype=np.uint64)
-
-    for counts in word_counts.values():
-        year_counts += counts
+def freqs_from_counts(word_counts, year_counts=None, corpus=None):
+    """ Divides the counts of each word by the total counts of each year.
+    The totals are summed over `word_counts` unless given in `year_counts`.
+    A `ColumnarCounts` is divided in one go and gives a `ColumnarCounts` of frequencies.
+    The excluded years of `corpus`, if given, are dropped, so the `years` of the result say which ones are
+    left; the arrays of a dict must then cover all the years of the corpus """
+    if hasattr(word_counts, 'counts'):
+        from utils import ColumnarCounts
+        if year_counts is None:
+            year_counts = word_counts.counts.sum(axis=0, dtype=np.uint64)
+        if corpus is None:
+            return ColumnarCounts(word_counts.vocab, word_counts.counts / year_counts,
+                                  word_counts.start_year, year_counts, word_counts.years)
+        years = word_counts.years
+        if years is None:
+            years = np.arange(word_counts.counts.shape[1]) + word_counts.start_year
+        kept = get_corpus(corpus).mask_for(years)
+        return ColumnarCounts(word_counts.vocab, word_counts.counts[:, kept] / year_counts[kept],
+                              word_counts.start_year, year_counts[kept], years[kept])
+
+    kept = slice(None) if corpus is None else get_corpus(corpus).mask
+    if year_counts is None:
+        some_value = next(iter(word_counts.values()))
+        year_counts = np.zeros(len(some_value), dtype=np.uint64)
+
+        for counts in word_counts.values():
+            year_counts += counts
+    year_counts = year_counts[kept]
 
     word_freqs = {}
     for word, counts in word_counts.items():
-        word_freqs[word] = counts / year_counts
+        word_freqs[word] = counts[kept] / year_counts
 
     return word_freqs
 
 
-def import_google(lang, n):
-    """ reduces range from 1800-2012 to 1840, 2000 """
-    from utils import load_google_counts
+def import_google(lang, n, word_counts=None):
+    """ reduces range from 1800-2012 to 1840, 2000
+    If `word_counts` is given (a count store, e.g. a `ColumnarCounts` from `agg_download.aggregate_shared`) it is used
+    instead of loading (lang, n) from disk """
+    from utils import load_filtered_counts, filter_counts
 
-    word_counts = load_google_counts(lang, n, 1800, 2012)
-    # select range 1840 -- 2000
-    for word, entry in word_counts.items():
-        word_counts[word] = word_counts[word][40:-12+1]
-    return freqs_from_counts(word_counts)
+    # words with resilience below the innermost ring are never drawn, so they are not even loaded.
+    # the yearly totals still include them, so the frequencies are the same as with the full corpus
+    if word_counts is None:
+        word_counts = load_filtered_counts(lang, n, 1800, 2012, years=(1840, 2001), min_resilience=50)
+    elif hasattr(word_counts, 'filter'):   # a `TieredCounts`, filtered without densifying its tail
+        word_counts = word_counts.filter(years=(1840, 2001), min_resilience=50)
+    else:
+        start_year = word_counts.start_year
+        word_counts = filter_counts(word_counts.iter_chunks(), start_year, start_year + word_counts.counts.shape[1],
+                                    years=(1840, 2001), min_resilience=50)
+    return freqs_from_counts(word_counts, word_counts.year_totals)
 
 
 # ----------------------------------------------------------------------------------------------------
 
 
-def go(langue, nbg, resolution):
+def go(langue, nbg, resolution, word_counts=None, workers=None, seed=None, strip_rows=None):
     ## ONLY WORKS WITH GOOGLE NOW
+    # `word_counts` skips loading from disk, see `import_google`
+    # `workers` lays out the sectors in parallel, `seed` makes the layout reproducible and `strip_rows`
+    # bounds the memory of the final image, see `make_chronocloud`
 
     debut = datetime.now()
-    words_frequencies = import_google(langue, nbg)
+    # the features only depend on (lang, n): they are computed once and loaded by later renders
+    get_freqs = partial(import_google, langue, nbg, word_counts)
+    if word_counts is None:
+        vocab, features = feature_index(langue, nbg, (1840, 2001), get_freqs)
+    else:
+        word_freqs = get_freqs()
+        vocab, features = word_freqs.vocab, compute_features(word_freqs.counts, 1840)
     fin = datetime.now()
     print('step 1: done / ' + str(fin - debut))
 
-    # TODO: cleanup to use numpy
-    words_carac = {}
-    the_max_vec = []
-    all_res = [50, 75, 100, 125, 150]
-    all_years = [1840, 1850, 1860, 1870, 1880, 1890, 1900, 1910, 1920, 1930, 1940, 1950, 1960, 1970, 1980, 1990]
-    for i in range(len(all_res)):
-        temp = []
-        for j in range(len(all_years)):
-            temp.append(0.0)
-        the_max_vec.append(temp)
-    for word in words_frequencies:
-        year_max_res = extract_year(words_frequencies[word], 1840)
-        frequency = extract_frequency(words_frequencies[word])
-        resilience = extract_resilience(words_frequencies[word])
-
-        words_carac[word] = [year_max_res, frequency, resilience]
-
-        if 50 <= resilience < 75:
-            for t in range(len(all_years)):
-                if year_max_res >= all_years[t] and year_max_res < all_years[t] + 10:
-                    the_max_vec[0][t] = max(the_max_vec[0][t], frequency)
-        if 75 <= resilience < 100:
-            for t in range(len(all_years)):
-                if year_max_res >= all_years[t] and year_max_res < all_years[t] + 10:
-                    the_max_vec[1][t] = max(the_max_vec[1][t], frequency)
-        if 100 <= resilience < 125:
-            for t in range(len(all_years)):
-                if year_max_res >= all_years[t] and year_max_res < all_years[t] + 10:
-                    the_max_vec[2][t] = max(the_max_vec[2][t], frequency)
-        if 125 <= resilience < 150:
-            for t in range(len(all_years)):
-                if year_max_res >= all_years[t] and year_max_res < all_years[t] + 10:
-                    the_max_vec[3][t] = max(the_max_vec[3][t], frequency)
-        if 150 <= resilience:
-            for t in range(len(all_years)):
-                if year_max_res >= all_years[t] and year_max_res < all_years[t] + 10:
-                    the_max_vec[4][t] = max(the_max_vec[4][t], frequency)
-    the_max_vec = list(filter(lambda a: a != 0, the_max_vec))
-    the_mean_vec = []
-    for i in range(len(the_max_vec)):
-        the_mean_vec.append(1.0 * sum(the_max_vec[i]) / len(the_max_vec[i]))
-    the_max = the_mean_vec[3]
-    word_to_sort = []
-    word_to_sort_freq = []
-    for word in words_carac.keys():
-        word_to_sort_freq.append(words_carac[word][1])
-        word_to_sort.append(word)
-    word_to_sort_freq, word_to_sort = zip(*sorted(zip(word_to_sort_freq, word_to_sort), reverse=True))
-    for i in range(len(word_to_sort)):
-        the_freq = min(word_to_sort_freq[i], the_max)
-        the_value = int(250.0 - (250.0 * the_freq / the_max))
-        words_carac[word_to_sort[i]].append('hsl(' + str(the_value) + ', 100%, 30%)')
+    words_carac = words_carac_from_features(vocab, features)
     fin = datetime.now()
     print('step 2: done / ' + str(fin - debut))
     name = langue + '_' + str(nbg) + '_' + str(resolution) + '_final'
     name = 'chrono_images/' + name
-    make_chronocloud(words_carac, resolution, name, langue)
+    make_chronocloud(words_carac, resolution, name, langue, workers, seed, strip_rows)
     fin = datetime.now()
     print('chronocloud "' + langue + '": done / ' + str(fin - debut))
 
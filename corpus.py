@@ -0,0 +1,48 @@
+import numpy as np
+
+
+class Corpus:
+    """ The years covered by a corpus, from `start_year` to `end_year` excluded, and the years in this
+    range whose data can't be trusted (`excluded`), e.g. missing issues of a newspaper.
+    Series over the corpus have one value per year of `years`; the excluded ones are skipped, not treated
+    as zeros, when computing resiliences, frequencies and fits. """
+    def __init__(self, name, start_year, end_year, excluded=()):
+        self.name = name
+        self.start_year = start_year
+        self.end_year   = end_year
+        self.excluded   = tuple(sorted(excluded))
+        self.years = np.arange(start_year, end_year)
+        self.mask  = self.mask_for(self.years)
+
+    def __repr__(self):
+        return 'Corpus(%r, %d, %d, excluded=%r)' % (self.name, self.start_year, self.end_year, self.excluded)
+
+    def mask_for(self, years):
+        """ False for the excluded years among `years` """
+        return ~np.isin(years, self.excluded)
+
+    def kept_years(self):
+        return self.years[self.mask]
+
+    def kept(self, series, years=None):
+        """ The values of `series` (last axis over `years`, by default all the years of the corpus)
+        for the years that are not excluded """
+        mask = self.mask if years is None else self.mask_for(years)
+        return np.asarray(series)[..., mask]
+
+
+CORPORA = {
+    'JDG'   : Corpus('JDG', 1826, 1998, excluded=[1837, 1859, 1860, 1917, 1918, 1919]),
+    'GDL'   : Corpus('GDL', 1798, 1998, excluded=[1800, 1801, 1802, 1803]),
+    'google': Corpus('google', 1800, 2012, excluded=[2009]),         # 2009 is an outlier
+}
+GOOGLE = CORPORA['google']
+
+
+def get_corpus(corpus):
+    """ The `Corpus` named `corpus` in `CORPORA`, or `corpus` itself if it is already one """
+    if isinstance(corpus, Corpus):
+        return corpus
+    if corpus not in CORPORA:
+        raise ValueError('Unknown corpus %r, expected one of %s' % (corpus, ', '.join(CORPORA)))
+    return CORPORA[corpus]
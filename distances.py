@@ -0,0 +1,107 @@
+import os
+import numpy as np
+import pandas as pd
+import numba
+
+from manifest import write_atomic
+
+
+CACHE_DIR = 'distance_cache'
+
+
+@numba.jit(nopython=True)
+def _popcount(x):
+    """ Number of bits set in the uint64 `x` """
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+@numba.jit(nopython=True, parallel=True)
+def _nmb_jaccard(bits, out):
+    """ Jaccard distance between any 2 rows of `bits`, bit-packed presence vectors as uint64 """
+    Y, W = bits.shape
+    for i in numba.prange(Y):
+        for j in range(i + 1, Y):
+            inter, union = 0, 0
+            for k in range(W):
+                inter += _popcount(bits[i, k] & bits[j, k])
+                union += _popcount(bits[i, k] | bits[j, k])
+            out[i, j] = 1 - inter / union if union else np.nan   # 2 empty years, as 0 / 0 in the notebook
+
+
+@numba.jit(nopython=True, parallel=True)
+def _nmb_l1(mat, out, block_size):
+    """ L1 distance between any 2 rows of `mat`. The columns go by blocks, so that the block of row `i`
+    stays in cache while it is compared with all the following rows """
+    Y, W = mat.shape
+    for i in numba.prange(Y):
+        acc = np.zeros(Y)
+        for lo in range(0, W, block_size):
+            hi = min(lo + block_size, W)
+            for j in range(i + 1, Y):
+                s = 0.0
+                for k in range(lo, hi):
+                    s += abs(mat[i, k] - mat[j, k])
+                acc[j] += s
+        for j in range(i + 1, Y):
+            out[i, j] = acc[j]
+
+
+def _upper_frame(out, index):
+    """ Upper triangular DataFrame like `get_distances` of `Draw_measure.ipynb`: NaN on and below the diagonal """
+    out[np.tril_indices(len(index))] = np.nan
+    return pd.DataFrame(out, index=index, columns=index)
+
+
+def jaccard_distances(presence):
+    """ Jaccard distance between any 2 years of `presence`, a boolean DataFrame with years as rows
+    and words as columns. Returns an upper triangular DataFrame, NaN between 2 years without any word """
+    return packed_jaccard_distances(pd.DataFrame(np.packbits(presence.values, axis=1), index=presence.index))
+
+
+def pack_presence(chunks, years):
+    """ Presence of the words in `years`, bit-packed, from `(words, years)` count matrices such as the chunks
+    of `ColumnarCounts.iter_chunks()`. Only one chunk is unpacked at a time, the result takes a bit per word
+    and year. Each chunk is padded to whole bytes with absent words, which changes no Jaccard distance.
+    Returns a uint8 DataFrame with years as rows, for `packed_jaccard_distances` """
+    bits = [np.packbits(np.asarray(chunk).T > 0, axis=1) for chunk in chunks]
+    bits = np.concatenate(bits, axis=1) if bits else np.zeros((len(years), 0), dtype=np.uint8)
+    return pd.DataFrame(bits, index=years)
+
+
+def packed_jaccard_distances(packed):
+    """ `jaccard_distances` of the presence bit-packed in the DataFrame `packed`, see `pack_presence` """
+    bits = packed.values
+    pad  = -bits.shape[1] % 8                  # whole uint64 words
+    bits = np.ascontiguousarray(np.pad(bits, ((0, 0), (0, pad)))).view(np.uint64)
+    out  = np.zeros((len(packed), len(packed)))
+    _nmb_jaccard(bits, out)
+    return _upper_frame(out, packed.index)
+
+
+def kernel_distances(ranks, block_size=4096):
+    """ Kernel distance between any 2 years of `ranks`, a DataFrame of **RANKS** (NOT normalised) with years
+    as rows and words as columns, i.e. the L1 distance between rows. Returns an upper triangular DataFrame """
+    out = np.zeros((len(ranks), len(ranks)))
+    _nmb_l1(np.ascontiguousarray(ranks.values, dtype=np.float64), out, block_size)
+    return _upper_frame(out, ranks.index)
+
+
+DISTANCES = {'jaccard': jaccard_distances, 'packed_jaccard': packed_jaccard_distances, 'kernel': kernel_distances}
+
+
+def cached_distances(kind, d, lang, n, filter_name, cache_dir=CACHE_DIR):
+    """ `DISTANCES[kind](d)`, cached on disk by (kind, lang, n, years of `d`, filter_name).
+    `filter_name` must describe how `d` was selected (e.g. 'all', 'res200-rank-kernel'), since it's not checked.
+    'jaccard' and 'packed_jaccard' give identical values, but are cached apart since their `d` differ """
+    years = '{}-{}'.format(d.index[0], d.index[-1])
+    cache_path = os.path.join(cache_dir, '{k}-{l}-{n}-{y}-{f}.npy'.format(k=kind, l=lang, n=n, y=years, f=filter_name))
+    if os.path.exists(cache_path):
+        return pd.DataFrame(np.load(cache_path), index=d.index, columns=d.index)
+
+    dist = DISTANCES[kind](d)
+    os.makedirs(cache_dir, exist_ok=True)
+    write_atomic(cache_path, lambda f: np.save(f, dist.values))
+    return dist
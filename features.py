@@ -0,0 +1,127 @@
+import os
+import heapq
+import numpy as np
+
+from corpus import get_corpus
+from manifest import write_atomic
+from utils import _nmb_resilience
+
+
+FEATURES_DIR = 'feature_cache'
+
+# what the chronocloud needs to know about each word: the year of its peak frequency, its total
+# frequency, its resilience (longest run of years where it appears) and the hue of its color
+FEATURE_DTYPE = [('year', np.uint16), ('freq', np.float64), ('res', np.uint8), ('hue', np.uint8)]
+
+RES_BANDS = [50, 75, 100, 125, 150]          # inner bound of each ring, the last one is the center
+DECADES   = list(range(1840, 1991, 10))      # first year of each sector
+
+
+def band_max(features):
+    """ `(len(RES_BANDS), len(DECADES))` matrix of the highest frequency of the words of each
+    (resilience band, peak decade) cell, 0 for empty cells and words outside the rings or decades """
+    res, year = features['res'].astype(np.int64), features['year'].astype(np.int64)
+    band   = np.searchsorted(RES_BANDS, res, side='right') - 1
+    decade = (year - DECADES[0]) // 10
+    inside = (band >= 0) & (year >= DECADES[0]) & (decade < len(DECADES))
+
+    the_max = np.zeros((len(RES_BANDS), len(DECADES)))
+    np.maximum.at(the_max, (band[inside], decade[inside]), features['freq'][inside])
+    return the_max
+
+
+def color_max(features):
+    """ The frequency of the darkest color: the mean over the decades of the highest frequency
+    in the 125-150 ring """
+    return band_max(features)[RES_BANDS.index(125)].mean()
+
+
+def sector_words(words_carac, max_words):
+    """ Assigns each word of `words_carac` (see `words_carac_from_features`) to its cell of the chronocloud
+    in a single pass. Returns `{cell: (frequencies, colors)}` where `cell` is `(resilience, decade)` for the
+    rings, e.g. `(50, 1840)`, and `(150, None)` for the center, ignoring the peak year.
+
+    Each cell keeps only its `max_words` most frequent words, the ones `WordCloud.generate_from_frequencies`
+    would keep, and in the same order as `words_carac`, so the layout doesn't change. """
+    cells = {}
+    for word, (year, freq, res, color) in words_carac.items():
+        if res >= RES_BANDS[-1]:
+            cell = (RES_BANDS[-1], None)
+        elif res >= RES_BANDS[0] and DECADES[0] <= year < DECADES[-1] + 10:
+            cell = (RES_BANDS[(res - RES_BANDS[0]) // 25], DECADES[(year - DECADES[0]) // 10])
+        else:
+            continue
+        cells.setdefault(cell, []).append(word)
+
+    sectors = {}
+    for cell, words in cells.items():
+        if len(words) > max_words:
+            # same as sorted(reverse=True)[:max_words], ties keep their order
+            kept = set(heapq.nlargest(max_words, words, key=lambda word: words_carac[word][1]))
+            words = [word for word in words if word in kept]
+        sectors[cell] = ({word: words_carac[word][1] for word in words},
+                         {word: words_carac[word][3] for word in words})
+    return sectors
+
+
+def compute_features(freqs, start_year=1840, corpus=None, years=None):
+    """ Features of each row of `freqs`, a `(words, years)` matrix of frequencies from `start_year`
+    such as the `counts` of `chronocloud_final.import_google`, or at `years` if given (e.g. `ColumnarCounts.years`).
+    The excluded years of `corpus`, if given, are skipped. Returns a structured array of `FEATURE_DTYPE`.
+    Raises ValueError if no word falls in the 125-150 ring, which gives the scale of the hue """
+    freqs = np.asarray(freqs)
+    years = np.arange(freqs.shape[1]) + start_year if years is None else np.asarray(years)
+    if corpus is not None:
+        kept = get_corpus(corpus).mask_for(years)
+        freqs, years = freqs[:, kept], years[kept]
+    features = np.empty(freqs.shape[0], dtype=FEATURE_DTYPE)
+    features['year'] = years[np.argmax(freqs, axis=1)]
+    features['freq'] = freqs.sum(axis=1)
+    features['res']  = _nmb_resilience(freqs.T)
+
+    # hue from 250 (blue) for rare words to 0 (red) for the most frequent ones
+    the_max = color_max(features)
+    if not the_max > 0:
+        raise ValueError('No word in the 125-150 resilience ring, the hue has no scale')
+    features['hue'] = 250.0 - (250.0 * np.minimum(features['freq'], the_max) / the_max)
+    return features
+
+
+def feature_path(lang, n, years, features_dir=FEATURES_DIR):
+    return os.path.join(features_dir, '{l}-{n}-{y0}-{y1}.npz'.format(l=lang, n=n, y0=years[0], y1=years[1] - 1))
+
+
+def load_features(lang, n, years, features_dir=FEATURES_DIR):
+    """ (vocab, features) of the index of (lang, n) over the (first, last) open interval of `years`,
+    or None if it hasn't been built """
+    file_path = feature_path(lang, n, years, features_dir)
+    if not os.path.exists(file_path):
+        return None
+    with np.load(file_path) as index:
+        return index['vocab'], index['features']
+
+
+def feature_index(lang, n, years, get_freqs, features_dir=FEATURES_DIR):
+    """ (vocab, features) of (lang, n) over `years`, computed from `get_freqs()` (a `ColumnarCounts`
+    of frequencies) the first time and loaded from `features_dir` afterwards """
+    index = load_features(lang, n, years, features_dir)
+    if index is not None:
+        return index
+
+    freqs = get_freqs()
+    vocab, features = np.asarray(freqs.vocab), compute_features(freqs.counts, years[0], years=freqs.years)
+    os.makedirs(features_dir, exist_ok=True)
+    write_atomic(feature_path(lang, n, years, features_dir),
+                 lambda f: np.savez(f, vocab=vocab, features=features))
+    return vocab, features
+
+
+def hsl_color(hue):
+    return 'hsl(' + str(int(hue)) + ', 100%, 30%)'
+
+
+def words_carac_from_features(vocab, features):
+    """ The `{word: [year, frequency, resilience, color]}` dictionary used by `make_chronocloud` """
+    return {word: [int(year), freq, int(res), hsl_color(hue)]
+            for word, year, freq, res, hue in zip(vocab.tolist(), features['year'], features['freq'],
+                                                  features['res'], features['hue'])}
@@ -0,0 +1,146 @@
+import os, time, queue, threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime
+
+import agg_download
+from agg_download import get_s3_bucket, pending_keys, key_basename, decompress_bytes, iter_line_blocks, \
+                         parse_region_task, merge_regions, cache_stats, save_counts, logger, backoff_delay
+from manifest import write_manifest
+from utils import counts_folder, BASE_PATH
+
+
+# each fetch thread keeps its own bucket, hence its own connection, across requests
+_thread_state = threading.local()
+
+def get_range(get_bucket, name, start, end, in_flight, num_tries=5):
+    """ Ranged GET of bytes [start, end] of key `name`. Releases a slot of `in_flight` when done """
+    try:
+        for attempt in range(num_tries):
+            try:
+                if not hasattr(_thread_state, 'bucket'):
+                    _thread_state.bucket = get_bucket()
+                key = _thread_state.bucket.get_key(name, validate=False)
+                return key.get_contents_as_string(headers={'Range': 'bytes={}-{}'.format(start, end)})
+            except Exception:
+                # usually a timeout; start over with a new connection, after a delay like `agg_download.retry`
+                if attempt == num_tries - 1:
+                    raise
+                if hasattr(_thread_state, 'bucket'):
+                    del _thread_state.bucket
+                time.sleep(backoff_delay(attempt))
+    finally:
+        in_flight.release()
+
+
+def fetch_ranges(key, get_bucket, fetcher, in_flight, range_size, window):
+    """ Yields the content of `key` in order, downloaded as ranged GETs of `range_size` bytes.
+    Up to `window` ranges of this key are requested ahead; `in_flight` bounds the requests of all the keys """
+    starts  = iter(range(0, key.size, range_size))
+    pending = []
+    while True:
+        while len(pending) < window:
+            start = next(starts, None)
+            if start is None:
+                break
+            in_flight.acquire()
+            end = min(start + range_size, key.size) - 1
+            pending.append(fetcher.submit(get_range, get_bucket, key.name, start, end, in_flight))
+        if not pending:
+            return
+        yield pending.pop(0).result()
+
+
+def feed_key(key, blocks, get_bucket, fetcher, in_flight, range_size, window, block_size):
+    """ Downloads and decompresses `key`, putting its line-aligned blocks on the `blocks` queue, which
+    blocks when the CPU workers are behind. Ends with ('done', key, number of blocks) or ('error', key, msg) """
+    try:
+        seq = 0
+        stream = fetch_ranges(key, get_bucket, fetcher, in_flight, range_size, window)
+        for buf in iter_line_blocks(decompress_bytes(stream, block_size)):
+            blocks.put(('block', key, seq, buf))
+            seq += 1
+        blocks.put(('done', key, seq, None))
+    except Exception as e:
+        blocks.put(('error', key, None, '{} failed: {}'.format(key.name, e)))
+
+
+def finish_key(key, futures, key_path, key_start, start_year, end_year):
+    """ Merges the parsed regions of `key` in order, saves them with the manifest and logs it """
+    try:
+        results = [future.result() for future in futures]
+        word_counts = merge_regions((region for region, _, _ in results), start_year, end_year)
+        save_counts(word_counts, key_path)
+        write_manifest(key, key_path, len(word_counts), time.time() - key_start)
+        logger((key, len(word_counts), sum(r[1] for r in results), sum(r[2] for r in results)))
+    except Exception as e:
+        logger('{} failed: {}'.format(key.name, e))
+
+
+def aggregate_pipeline(lang, n, start_year, end_year, base_path=BASE_PATH, get_bucket=get_s3_bucket,
+                       fetch_keys=4, max_in_flight=16, range_size=2**23, cpu_workers=None, queue_size=32,
+                       block_size=2**22, verify=False):
+    """ Same result as `agg_download.aggregate`, but downloading and parsing are separate stages, so that
+    CPU workers don't wait on the network and network stalls don't idle the CPUs.
+
+    Parameters:
+    -----------
+        base_path    : where to save, as for `utils.counts_folder`
+        get_bucket   : returns a bucket; called once per fetch thread. E.g. `lambda: LocalBucket(root)`
+        fetch_keys   : number of keys downloaded at the same time
+        max_in_flight: number of ranged GETs in flight over all the keys
+        range_size   : bytes per ranged GET
+        cpu_workers  : processes parsing the blocks. Default: number of CPUs
+        queue_size   : decompressed blocks waiting for a CPU worker, beyond which downloads pause
+        block_size   : minimum size of a decompressed block sent to a CPU worker
+        verify       : checksum existing outputs, see `manifest.is_complete`
+    """
+    root_path = counts_folder(lang, n, start_year, end_year, base_path)
+    os.makedirs(root_path, exist_ok=True)
+    cpu_workers = cpu_workers or os.cpu_count()
+
+    agg_download.log_file = open("{l}{n}{date:%m-%d-%H-%M}-pipeline.log".format(
+        l=lang, n=n, date=datetime.now()), "a")
+    agg_download.start_time = time.time() - 1 # to avoid 0 time
+
+    keys = [key for key, _ in pending_keys(get_bucket(), lang, n, root_path, verify)]
+
+    # start the processes before any thread, so that they are not forked from a threaded parent
+    parsers = ProcessPoolExecutor(cpu_workers)
+    for future in [parsers.submit(cache_stats) for _ in range(cpu_workers)]:
+        future.result()
+
+    blocks    = queue.Queue(queue_size)
+    cpu_slots = threading.BoundedSemaphore(2 * cpu_workers)   # blocks submitted but not parsed yet
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    fetcher   = ThreadPoolExecutor(max_in_flight)
+    feeders   = ThreadPoolExecutor(fetch_keys)
+    finisher  = ThreadPoolExecutor(1)                          # single thread, since `logger` uses globals
+
+    window = max(1, max_in_flight // fetch_keys)
+    key_start = {}
+    for key in keys:
+        key_start[key.name] = time.time()
+        feeders.submit(feed_key, key, blocks, get_bucket, fetcher, in_flight, range_size, window, block_size)
+
+    regions = {}
+    remaining = len(keys)
+    while remaining:
+        kind, key, seq, data = blocks.get()
+        if kind == 'block':
+            cpu_slots.acquire()
+            future = parsers.submit(parse_region_task, data, start_year, end_year)
+            future.add_done_callback(lambda _: cpu_slots.release())
+            regions.setdefault(key.name, []).append(future)
+            continue
+
+        remaining -= 1
+        futures = regions.pop(key.name, [])
+        if kind == 'error':
+            logger(data)
+            continue
+        key_path = os.path.join(root_path, key_basename(key) + '.pkl')
+        finisher.submit(finish_key, key, futures, key_path, key_start[key.name], start_year, end_year)
+
+    for executor in [feeders, fetcher, finisher, parsers]:
+        executor.shutdown()
+    agg_download.log_file.close()
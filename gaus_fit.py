@@ -1,41 +1,25 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import scipy
-import pymysql
+import numpy as np
 import multiprocessing
 from functools import partial
 from datetime import datetime
 from lmfit.models import GaussianModel
+from result_sink import fit_row, MySQLSink, ListSink
+from corpus import get_corpus
+from utils import word_resilience
 
 def extract_resilience(frequencies,journal):
-    if journal=='JDG':
-        years=list(range(1826,1998))
-        years_remove=[1837,1859,1860,1917,1918,1919]
-    if journal=='GDL':
-        years=list(range(1798,1998))
-        years_remove=[1800,1801,1802,1803]
-    resilience=0
-    resilience_max=0
-    for i in range(len(years)):
-        if years[i] not in years_remove:
-            if frequencies[i]!=0.0:
-                resilience+=1
-            else:
-                resilience_max=max(resilience_max,resilience)
-                resilience=0
-    resilience_max=max(resilience_max,resilience)
-    return resilience_max
+    # longest run of years with the word, skipping the excluded years of the corpus, see `corpus.CORPORA`
+    corpus=get_corpus(journal)
+    return int(word_resilience(corpus.kept(np.asarray(frequencies,dtype=np.float64))))
 
 def fit(les_x_init,les_y_init,remove):
-    les_x=[]
-    les_y=[]
-    for i in range(len(les_x_init)):
-        if les_x_init[i] not in remove:
-            les_x.append(les_x_init[i])
-            les_y.append(les_y_init[i])
-    x=scipy.asarray(les_x)
-    y=scipy.asarray(les_y)
+    les_x_init=np.asarray(les_x_init,dtype=np.float64)
+    keep=~np.isin(les_x_init,remove)
+    x=les_x_init[keep]
+    y=np.asarray(les_y_init,dtype=np.float64)[keep]
     gmod=GaussianModel()
     param=gmod.guess(y, x=x)
     amplitude=param['amplitude'].value
@@ -47,54 +31,31 @@ def fit(les_x_init,les_y_init,remove):
     center=the_fit.params['center'].value
     sigma=the_fit.params['sigma'].value
     best_sol=[amplitude,center,sigma]
-    y_fit=[]
-    for i in range(len(les_x_init)):
-        y_fit.append(gmod.eval(x=les_x_init[i],amplitude=amplitude,center=center,sigma=sigma))
+    y_fit=gmod.eval(x=les_x_init,amplitude=amplitude,center=center,sigma=sigma)
     return [best_sol,best_res,y_fit]
 
-def gauss_fit(mot,dico,level,gram_tot,cursor,table,journal):
-    if journal=='JDG':
-        years=list(range(1826,1998))
-        years_remove=[1837,1859,1860,1917,1918,1919]
-    if journal=='GDL':
-        years=list(range(1798,1998))
-        years_remove=[1800,1801,1802,1803]
+def gauss_fit(mot,dico,level,gram_tot,sink,journal):
+    corpus=get_corpus(journal)
     gram_split=gram_tot.split(' ')
     nbg=len(gram_split)
-    the_fit=fit(years,dico[mot][0],years_remove)
-    moyenne=sum(dico[mot][0])/len(dico[mot][0])
-    moyenne_fit=sum(the_fit[2])/len(the_fit[2])
-    val_0=0.0
-    val_1=0.0
-    val_2=0.0
-    for i in range(len(years)):
-        if years[i] not in years_remove:
-            val_0+=(dico[mot][0][i]-moyenne)*(the_fit[2][i]-moyenne_fit)
-            val_1+=(dico[mot][0][i]-moyenne)**2
-            val_2+=(the_fit[2][i]-moyenne_fit)**2
+    freqs=np.asarray(dico[mot][0],dtype=np.float64)
+    the_fit=fit(corpus.years,freqs,corpus.excluded)
+    # the means are over all the years, the sums only over the years kept
+    ecart=freqs-freqs.mean()
+    ecart_fit=the_fit[2]-the_fit[2].mean()
+    val_0=(ecart*ecart_fit)[corpus.mask].sum()
+    val_1=(ecart**2)[corpus.mask].sum()
+    val_2=(ecart_fit**2)[corpus.mask].sum()
     if val_1!=0.0 and val_2!=0.0:
         score=1.0-(val_0**2/(val_1*val_2))
-        variables='(nbg,gram'
-        for i in range(9):
-            variables+=',gram_'+str(i+1)
-        variables+=',amplitude,center,sigma,residus,fit_quality)'
-        valeurs='('+str(nbg)+',"'+gram_tot+'"'
-        for i in range(len(gram_split)):
-            valeurs+=',"'+gram_split[i]+'"'
-        for i in range(len(gram_split),9):
-            valeurs+=',""'
-        valeurs+=','+str(the_fit[0][0])
-        valeurs+=','+str(the_fit[0][1])
-        valeurs+=','+str(the_fit[0][2])
-        valeurs+=','+str(the_fit[1])
-        valeurs+=','+str(score)+')'
-        cursor.execute('INSERT INTO '+table+' '+variables+' VALUES '+valeurs)
+        sink.add(fit_row(gram_tot,the_fit[0][0],the_fit[0][1],the_fit[0][2],the_fit[1],score))
         if nbg!=level:
             if dico[mot][1]!={}:
                 for gram in dico[mot][1].keys():
-                    gauss_fit(gram,dico[mot][1],level,gram_tot+' '+gram,cursor,table,journal)
+                    gauss_fit(gram,dico[mot][1],level,gram_tot+' '+gram,sink,journal)
 
-def go(journal):
+def go(journal,sink=None):
+    # `sink` receives the fits, see `result_sink`. By default they go to the `<journal>_gaussians` MySQL table
     liste_mots=[]
     liste_sommes=[]
     if journal=='JDG':
@@ -107,22 +68,83 @@ def go(journal):
             #if extract_resilience(gdl[mot][0],journal)==196:
             if extract_resilience(gdl[mot][0],journal)>=100:
                 liste_mots.append(mot)
-    connection=pymysql.connect(host='cdh-dhlabpc3.epfl.ch',user='',password='',db='ling_cap',charset='utf8')
-    cursor=connection.cursor()
-    table=journal+'_gaussians'
+    if sink is None:
+        sink=MySQLSink(journal+'_gaussians')
     compteur=0
     longueur=len(liste_mots)
     if journal=='JDG':
         for mot in liste_mots:
-            gauss_fit(mot,jdg,9,mot,cursor,table,journal)
+            gauss_fit(mot,jdg,9,mot,sink,journal)
             compteur+=1
             print(journal+' / '+str(compteur)+' / '+str(longueur)+' / '+mot)
     if journal=='GDL':
         for mot in liste_mots:
-            gauss_fit(mot,gdl,9,mot,cursor,table,journal)
+            gauss_fit(mot,gdl,9,mot,sink,journal)
+            compteur+=1
+            print(journal+' / '+str(compteur)+' / '+str(longueur)+' / '+mot)
+    sink.close()
+
+_dicos={}
+
+def init_worker(dicos):
+    global _dicos
+    _dicos=dicos
+
+def fit_word(task):
+    # all the fits of the tree of `mot`, in the order `gauss_fit` makes them
+    journal,mot,level=task
+    sink=ListSink()
+    gauss_fit(mot,_dicos[journal],level,mot,sink,journal)
+    sink.close()
+    return sink.written
+
+def read_progress(sink):
+    # (number of words whose fits are committed, last of these words)
+    progress=sink.read_progress()
+    if progress is None:
+        return 0,None
+    return progress['done'],progress['word']
+
+def go_parallel(dicos,sinks=None,workers=None,level=9,commit_words=100):
+    """ Same fits as `go` for each journal of `dicos` ({'GDL': gdl, 'JDG': jdg}), with the words of all the
+    journals fitted in a pool of `workers` processes. The fits reach the sink of their journal (by default
+    its MySQL table) in the same order as with `go`.
+
+    Every `commit_words` words the sink is committed along with the number of words done, in the same
+    transaction, so that a new run on the same words starts right after the last committed one. For this
+    to be exact, given `sinks` must not commit on their own (`commit_every=None`) """
+    sinks=dict(sinks or {})
+    tasks=[]
+    todo={}
+    for journal,dico in dicos.items():
+        liste_mots=[mot for mot in dico.keys() if extract_resilience(dico[mot][0],journal)>=100]
+        if journal not in sinks:
+            sinks[journal]=MySQLSink(journal+'_gaussians',commit_every=None)
+        if sinks[journal].commit_every is not None:
+            raise ValueError('The sink of %s commits on its own, its progress could not be kept' % journal)
+        done,last_word=read_progress(sinks[journal])
+        if done and (done>len(liste_mots) or liste_mots[done-1]!=last_word):
+            raise ValueError('Progress of %s (%d words, up to %r) does not match its words' % (journal,done,last_word))
+        if not done:
+            # marks the start, so that rows of a crashed first batch are not kept
+            sinks[journal].commit(progress={'done':0,'word':None})
+        todo[journal]=(done,len(liste_mots))
+        tasks+=[(journal,mot,level) for mot in liste_mots[done:]]
+
+    with multiprocessing.Pool(workers,initializer=init_worker,initargs=(dicos,)) as pool:
+        for (journal,mot,_),rows in zip(tasks,pool.imap(fit_word,tasks,chunksize=4)):
+            sink=sinks[journal]
+            sink.add_many(rows)
+            compteur,longueur=todo[journal]
             compteur+=1
+            todo[journal]=(compteur,longueur)
             print(journal+' / '+str(compteur)+' / '+str(longueur)+' / '+mot)
-    connection.close()
+            if compteur%commit_words==0 or compteur==longueur:
+                sink.flush()
+                sink.commit(progress={'done':compteur,'word':mot})
+    for sink in sinks.values():
+        sink.close()
 
-go('GDL')
-go('JDG')
+if __name__=='__main__':
+    go('GDL')
+    go('JDG')
@@ -0,0 +1,170 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from corpus import get_corpus
+
+SQRT_2PI = np.sqrt(2 * np.pi)
+
+FIT_FIELDS = ['amplitude', 'center', 'sigma', 'chisqr', 'fit_quality']
+
+
+def gaussian(x, amplitude, center, sigma):
+    """ The `GaussianModel` of lmfit, broadcast over words: parameters are `(words, 1)` and `x` is `(years,)` """
+    return amplitude / (sigma * SQRT_2PI) * np.exp(-(x - center) ** 2 / (2 * sigma ** 2))
+
+
+def guess_params(y, x):
+    """ Initial (amplitude, center, sigma) of each row of `y`, as `GaussianModel.guess` does it: the width
+    and center of the points above half the maximum, or of the whole range if there are at most 2 of them """
+    maxy, miny = y.max(axis=1), y.min(axis=1)
+    center = x[np.argmax(y, axis=1)].astype(np.float64)
+    sigma  = np.full(len(y), (x.max() - x.min()) / 6.0)
+
+    above = y > ((maxy + miny) / 2.0)[:, None]
+    num_above = above.sum(axis=1)
+    wide = num_above > 2
+    first = np.argmax(above, axis=1)
+    last  = len(x) - 1 - np.argmax(above[:, ::-1], axis=1)
+    sigma[wide]  = (x[last[wide]] - x[first[wide]]) / 2.0
+    center[wide] = (above[wide] * x).sum(axis=1) / num_above[wide]
+
+    amplitude = (maxy - miny) * 3.0 * sigma
+    return amplitude, center, sigma
+
+
+def _chisqr(y, x, params):
+    return ((gaussian(x, *[p[:, None] for p in params]) - y) ** 2).sum(axis=1)
+
+
+def levenberg_marquardt(y, x, params, max_iter=200, tol=1e-10):
+    """ Least squares fit of a Gaussian to each row of `y` at once, from the initial `params`.
+    Each row has its own damping, which goes down after a step that improves it and up otherwise;
+    steps that would make sigma negative are refused, like the `min=0` of lmfit.
+    Returns (params, chisqr, converged) """
+    params = np.array(params, dtype=np.float64)                # (3, words)
+    chisqr = _chisqr(y, x, params)
+    damping = np.full(len(y), 1e-3)
+    converged = np.zeros(len(y), dtype=bool)
+
+    for _ in range(max_iter):
+        active = np.flatnonzero(~converged)
+        if not len(active):
+            break
+        amplitude, center, sigma = [p[active, None] for p in params]
+        unit = gaussian(x, 1.0, center, sigma)                 # derivative by the amplitude
+        f = amplitude * unit
+        d = x - center
+        jac = np.stack([unit, f * d / sigma ** 2, f * (d ** 2 / sigma ** 3 - 1 / sigma)], axis=1)
+        residuals = y[active] - f
+
+        jtj = np.einsum('wiy,wjy->wij', jac, jac)
+        jtr = np.einsum('wiy,wy->wi', jac, residuals)
+
+        # (J'J + damping diag(J'J)) step = J'r, scaled by the diagonal: the parameters have very different
+        # scales (amplitudes of 1e-4, centers of 1900) and the damped system is then positive definite
+        scale = np.sqrt(np.einsum('wii->wi', jtj))
+        scale[scale == 0] = 1
+        lhs = jtj / (scale[:, :, None] * scale[:, None, :]) + damping[active, None, None] * np.eye(3)
+        ok = np.isfinite(lhs).all(axis=(1, 2)) & np.isfinite(jtr).all(axis=1)
+        step = np.zeros((len(active), 3))
+        step[ok] = np.linalg.solve(lhs[ok], (jtr[ok] / scale[ok])[:, :, None])[:, :, 0] / scale[ok]
+
+        new_params = params[:, active] + step.T
+        new_chisqr = _chisqr(y[active], x, new_params)
+        better = ok & (new_params[2] > 0) & np.isfinite(new_chisqr) & (new_chisqr <= chisqr[active])
+
+        improvement = (chisqr[active] - new_chisqr) / np.maximum(chisqr[active], 1e-300)
+        params[:, active[better]] = new_params[:, better]
+        chisqr[active[better]] = new_chisqr[better]
+        damping[active[better]] = np.maximum(damping[active[better]] / 10, 1e-12)
+        damping[active[~better]] *= 10
+
+        converged[active[better & (improvement < tol)]] = True
+        converged[active[~better & (damping[active] > 1e10)]] = True   # no step improves anymore
+    return params, chisqr, converged & np.isfinite(chisqr)
+
+
+def fit_quality(freqs, fitted, mask):
+    """ The score of `gaus_fit.gauss_fit`: 1 - r^2 between the data and the fit, with their means over all
+    the years but the sums over the years of `mask` only. NaN where the data or the fit is constant """
+    d = freqs - freqs.mean(axis=1, keepdims=True)
+    f = fitted - fitted.mean(axis=1, keepdims=True)
+    val_0 = (d * f)[:, mask].sum(axis=1)
+    val_1 = (d ** 2)[:, mask].sum(axis=1)
+    val_2 = (f ** 2)[:, mask].sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = 1.0 - val_0 ** 2 / (val_1 * val_2)
+    score[(val_1 == 0) | (val_2 == 0)] = np.nan
+    return score
+
+
+def lmfit_gaussian(y, x):
+    """ (amplitude, center, sigma, chisqr) of the lmfit fit of `gaus_fit.fit`, or None if lmfit is missing """
+    try:
+        from lmfit.models import GaussianModel
+    except ImportError:
+        return None
+    gmod = GaussianModel()
+    param = gmod.guess(y, x=x)
+    the_fit = gmod.fit(y, x=x, amplitude=param['amplitude'].value, center=param['center'].value,
+                       sigma=param['sigma'].value)
+    p = the_fit.params
+    return p['amplitude'].value, p['center'].value, p['sigma'].value, the_fit.chisqr
+
+
+def _fit_chunk(freqs, years, mask, max_iter, tol, fallback):
+    freqs = np.asarray(freqs, dtype=np.float64)
+    x, y = years[mask].astype(np.float64), freqs[:, mask]
+    params, chisqr, converged = levenberg_marquardt(y, x, guess_params(y, x), max_iter, tol)
+
+    if fallback:
+        for i in np.flatnonzero(~converged):
+            result = lmfit_gaussian(y[i], x)
+            if result is None:
+                break
+            params[:, i], chisqr[i] = result[:3], result[3]
+            converged[i] = True
+
+    fitted = gaussian(years.astype(np.float64), *[p[:, None] for p in params])
+    result = np.empty(len(freqs), dtype=[(field, np.float64) for field in FIT_FIELDS] + [('converged', bool)])
+    result['amplitude'], result['center'], result['sigma'] = params
+    result['chisqr'] = chisqr
+    result['fit_quality'] = fit_quality(freqs, fitted, mask)
+    result['converged'] = converged
+    return result
+
+
+def fit_gaussians(freqs, years, mask=None, max_iter=200, tol=1e-10, chunk_rows=4096, workers=None, fallback=True,
+                  corpus=None):
+    """ Fits a Gaussian to the frequencies of each word, like `gaus_fit.fit` but for all the words at once.
+
+    Parameters:
+    -----------
+        freqs     : `(words, years)` matrix of frequencies, e.g. `ColumnarCounts.counts`
+        years     : the year of each column
+        mask      : boolean array, False for the years left out of the fit (the `years_remove` of `gaus_fit`)
+        corpus    : a `corpus.Corpus` or its name, whose excluded years give the mask if it isn't given
+        max_iter  : maximal number of Levenberg-Marquardt iterations
+        tol       : relative improvement of chisqr under which a fit has converged
+        chunk_rows: words fitted together, in `workers` processes if given
+        fallback  : fit again with lmfit, if installed, the words that didn't converge
+
+    Returns a structured array with the fields of `FIT_FIELDS` and whether the fit converged.
+    """
+    years = np.asarray(years)
+    if mask is None:
+        mask = np.ones(len(years), dtype=bool) if corpus is None else get_corpus(corpus).mask_for(years)
+    mask = np.asarray(mask, dtype=bool)
+    assert freqs.shape[1] == len(years) == len(mask), "One year and one mask value per column"
+
+    chunks = [freqs[lo:lo + chunk_rows] for lo in range(0, freqs.shape[0], chunk_rows)]
+    args = (max_iter, tol, fallback)
+    if workers and workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(_fit_chunk, np.asarray(chunk), years, mask, *args) for chunk in chunks]
+            results = [future.result() for future in futures]
+    else:
+        results = [_fit_chunk(chunk, years, mask, *args) for chunk in chunks]
+    if not results:
+        return _fit_chunk(np.zeros((0, len(years))), years, mask, *args)
+    return np.concatenate(results)
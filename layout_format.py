@@ -0,0 +1,155 @@
+import re
+import sys
+import ast
+import glob
+import numpy as np
+from os import path
+from PIL import Image, ImageDraw, ImageFont
+
+from manifest import write_atomic
+from tiles import get_font, render_strips, write_png_rows
+
+
+# one entry per word placed in the chronocloud, with the fields of a `WordCloud.layout_` entry:
+# ((word, freq), font_size, (x, y), orientation, color) where `x` is the row, `y` the column
+# and the color is 'hsl(hue, 100%, 30%)'. No orientation (horizontal) is stored as -1
+LAYOUT_DTYPE = [('word', np.uint32), ('freq', np.float64), ('font_size', np.uint16),
+                ('x', np.uint32), ('y', np.uint32), ('orientation', np.int8), ('hue', np.uint8)]
+
+HSL_COLOR = re.compile(r"hsl\((\d+), 100%, 30%\)")
+
+
+def string_table(strings):
+    """ (data, offsets) of `strings` in UTF-8, the i-th being `data[offsets[i]:offsets[i + 1]]` """
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    if offsets[-1] < 2**32:
+        offsets = offsets.astype(np.uint32)
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def strings_from_table(data, offsets):
+    data = data.tobytes()
+    return [data[lo:hi].decode('utf-8') for lo, hi in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+def pack_layout(layout, words, n):
+    """ Converts a `WordCloud.layout_` and its `words_` to the arrays of the binary format.
+    The string table starts with `words`, which hold every word of the layout and many more,
+    followed by the words of the layout missing from them, if any """
+    vocab = list(words)
+    ids = {}
+    for i, word in enumerate(vocab):
+        ids.setdefault(word, i)
+    def word_id(word):
+        if word not in ids:
+            ids[word] = len(vocab)
+            vocab.append(word)
+        return ids[word]
+
+    entries = np.empty(len(layout), dtype=LAYOUT_DTYPE)
+    for i, ((word, freq), font_size, (x, y), orientation, color) in enumerate(layout):
+        hue = HSL_COLOR.fullmatch(color)
+        if hue is None:
+            raise ValueError('Unexpected color %r for %r' % (color, word))
+        entries[i] = (word_id(word), freq, font_size, x, y, -1 if orientation is None else orientation, int(hue.group(1)))
+
+    data, offsets = string_table(vocab)
+    return dict(entries=entries, num_words=np.array(len(words)), strings=data, offsets=offsets, size=np.array(n))
+
+
+def save_layout(file_path, layout, words, n):
+    """ Writes the layout of an `n` px chronocloud to `file_path` (.npz). See `load_layout` """
+    arrays = pack_layout(layout, words, n)
+    write_atomic(file_path, lambda f: np.savez(f, **arrays))
+
+
+class ChronoLayout:
+    """ A chronocloud layout read from disk: `entries` is a structured array of `LAYOUT_DTYPE`,
+    `vocab` the string table its `word` field refers to, whose first `num_words` are the `WordCloud.words_`,
+    and `n` the size of the image """
+    def __init__(self, entries, vocab, num_words, n):
+        self.entries = entries
+        self.vocab   = vocab
+        self.num_words = num_words
+        self.n       = n
+
+    def __len__(self):
+        return len(self.entries)
+
+    def layout(self, selection=slice(None)):
+        """ The `WordCloud.layout_` entries, as they were given to `save_layout` """
+        return [((self.vocab[e['word']], float(e['freq'])), int(e['font_size']), (int(e['x']), int(e['y'])),
+                 None if e['orientation'] < 0 else int(e['orientation']), 'hsl(%d, 100%%, 30%%)' % e['hue'])
+                for e in self.entries[selection]]
+
+    def word_list(self):
+        return self.vocab[:self.num_words]
+
+
+def load_layout(file_path):
+    with np.load(file_path) as f:
+        vocab = strings_from_table(f['strings'], f['offsets'])
+        return ChronoLayout(f['entries'], vocab, int(f['num_words']), int(f['size']))
+
+
+def render_layout(chrono_layout, file_path, font_path, legend=None, strip_rows=1024):
+    """ Draws a saved layout to the PNG `file_path` without running WordCloud again. `legend` are the labels
+    of `tiles.legend_labels`, if any. Written in strips, see `tiles.render_tiled` """
+    n = chrono_layout.n
+    strips = render_strips(n, chrono_layout.layout(), legend or [], font_path, strip_rows)
+    write_png_rows(file_path, n, n, strips)
+
+
+def render_region(chrono_layout, font_path, rows, cols):
+    """ The (rows[0]:rows[1], cols[0]:cols[1]) part of the words of the chronocloud as an RGB array.
+    Only the words starting close enough to the region are drawn """
+    entries = chrono_layout.entries
+    lengths = np.array([len(word) + 1 for word in chrono_layout.vocab], dtype=np.int64)
+    extent  = entries['font_size'] * lengths[entries['word']]     # no glyph is wider than its font size
+    x, y = entries['x'].astype(np.int64), entries['y'].astype(np.int64)
+    near = np.flatnonzero((x < rows[1]) & (x + extent >= rows[0]) & (y < cols[1]) & (y + extent >= cols[0]))
+
+    image = Image.new('RGB', (cols[1] - cols[0], rows[1] - rows[0]), 'white')
+    draw  = ImageDraw.Draw(image)
+    for (word, _), font_size, (x, y), orientation, color in chrono_layout.layout(near):
+        font = ImageFont.TransposedFont(get_font(font_path, font_size), orientation=orientation)
+        draw.text((y - cols[0], x - rows[0]), word, fill=color, font=font)
+    return np.asarray(image)
+
+
+def read_text_layout(layout_path):
+    """ (layout, words) from the `_chronodata_layout_alt.txt` and `_chronodata_words_alt.txt` of the first renders """
+    with open(layout_path) as f:
+        layout = [ast.literal_eval(line) for line in f if line.strip()]
+    words_path = layout_path.replace('_chronodata_layout_alt.txt', '_chronodata_words_alt.txt')
+    words = []
+    if path.exists(words_path):
+        with open(words_path) as f:
+            words = [line.rstrip('\n') for line in f]
+    return layout, words
+
+
+def convert_text_layouts(folder):
+    """ Writes the binary `_chronodata_layout.npz` next to each text layout of `folder`,
+    e.g. 'chrono_images'. The size of the image is taken from the name, `lang_n_size_final` """
+    converted = []
+    for layout_path in sorted(glob.glob(path.join(folder, '*_chronodata_layout_alt.txt'))):
+        name = layout_path[:-len('_chronodata_layout_alt.txt')]
+        size = re.search(r'_(\d+)_final$', name)
+        if size is None:
+            raise ValueError('No image size in the name of ' + layout_path)
+        layout, words = read_text_layout(layout_path)
+        save_layout(name + '_chronodata_layout.npz', layout, words, int(size.group(1)))
+        converted.append(name)
+        print(path.basename(name), len(layout))
+    return converted
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python layout_format.py folder [folder ...]')
+        sys.exit()
+    for folder in sys.argv[1:]:
+        convert_text_layouts(folder)
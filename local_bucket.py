@@ -0,0 +1,50 @@
+import os, re
+from functools import partial
+
+
+class LocalKey:
+    """ Stand-in for a boto2 S3 key backed by a local file. Supports what the aggregation uses:
+    `name`, `size`, `etag`, iterating over the content in chunks and ranged `get_contents_as_string` """
+    BufferSize = 8192
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name   = name
+        self.path   = os.path.join(bucket.root, name)
+        stat = os.stat(self.path)
+        self.size = stat.st_size
+        self.etag = '"{:x}-{:x}"'.format(stat.st_size, int(stat.st_mtime))
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            for chunk in iter(partial(f.read, self.BufferSize), b''):
+                yield chunk
+
+    def get_contents_as_string(self, headers=None):
+        """ The whole content, or the inclusive byte range given as {'Range': 'bytes=start-end'} """
+        start, end = 0, self.size - 1
+        if headers and 'Range' in headers:
+            start, end = map(int, re.match(r'bytes=(\d+)-(\d+)', headers['Range']).groups())
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start + 1)
+
+    def __repr__(self):
+        return '<LocalKey: {}>'.format(self.name)
+
+
+class LocalBucket:
+    """ Directory-backed stand-in for the bucket returned by `agg_download.get_s3_bucket()`,
+    where the key names are the paths relative to `root` """
+    def __init__(self, root):
+        self.root = root
+
+    def list(self, prefix='', delimiter=''):
+        folder = os.path.join(self.root, os.path.dirname(prefix))
+        for entry in sorted(os.listdir(folder)):
+            name = os.path.join(os.path.dirname(prefix), entry)
+            if name.startswith(prefix) and os.path.isfile(os.path.join(self.root, name)):
+                yield LocalKey(self, name)
+
+    def get_key(self, name, validate=True):
+        return LocalKey(self, name)
@@ -0,0 +1,62 @@
+import os, json, hashlib
+
+
+def manifest_path(save_path):
+    """ The manifest of a shard sits next to its output, e.g. `th.json` for `th.pkl` """
+    return os.path.splitext(save_path)[0] + '.json'
+
+
+def file_checksum(file_path, block_size=2**20):
+    """ SHA-1 of a file, read in blocks """
+    sha = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def write_atomic(file_path, write):
+    """ Calls `write(f)` on a temporary file which is renamed to `file_path` only once it's complete,
+    so that a killed worker never leaves a truncated file behind """
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+
+def write_manifest(key, save_path, num_words, duration):
+    """ Records what was used to produce `save_path` and how to check it later """
+    entry = {
+        'key'      : key.name,
+        'size'     : key.size,
+        'etag'     : key.etag,
+        'file_size': os.path.getsize(save_path),
+        'sha1'     : file_checksum(save_path),
+        'words'    : num_words,
+        'duration' : round(duration, 1),
+    }
+    write_atomic(manifest_path(save_path), lambda f: f.write(json.dumps(entry, indent=1).encode('utf-8')))
+
+
+def read_manifest(save_path):
+    """ Returns the manifest entry of `save_path`, or None if it has none (or an unreadable one) """
+    try:
+        with open(manifest_path(save_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_complete(save_path, key=None, verify=False):
+    """ Whether `save_path` was completely written from the current version of `key`.
+    The output size is always checked; with `verify=True` its checksum is recomputed as well """
+    entry = read_manifest(save_path)
+    if entry is None or not os.path.exists(save_path):
+        return False
+    if key is not None and (entry['size'] != key.size or entry['etag'] != key.etag):
+        return False
+    if os.path.getsize(save_path) != entry['file_size']:
+        return False
+    return not verify or file_checksum(save_path) == entry['sha1']
@@ -0,0 +1,87 @@
+import os, sys, json, time, traceback
+from collections import defaultdict
+
+
+# set in each worker by `init_metrics`; nothing is sent while it is None
+_queue = None
+_interval = 10
+_key = None
+_counters = defaultdict(float)
+_last_flush = time.time()
+
+def init_metrics(q, interval=10, key=None):
+    """ Pool initializer: the worker sends its counters to `q` every `interval` seconds, attributed
+    to `key` until `set_key` is called, e.g. in the workers that all share one large key """
+    global _queue, _interval, _last_flush, _key
+    _queue, _interval, _last_flush, _key = q, interval, time.time(), key
+    # a forked worker starts with the counters its parent had not sent yet
+    _counters.clear()
+
+
+def set_key(name):
+    """ Sends what was counted for the previous key, then attributes the counters to key `name` """
+    global _key
+    flush()
+    _key = name
+
+
+def add(name, value):
+    """ Adds `value` to counter `name` of this worker, sending the counters if it's time """
+    _counters[name] += value
+    if _queue is not None and time.time() - _last_flush > _interval:
+        flush()
+
+
+def flush():
+    """ Sends the counters accumulated since the last flush to the listener, and resets them """
+    global _last_flush
+    if _queue is None or not _counters:
+        return
+    now = time.time()
+    record = {'time': round(now, 3), 'pid': os.getpid(), 'key': _key, 'elapsed_s': round(now - _last_flush, 3)}
+    record.update(_counters)
+    _queue.put(record)
+    _counters.clear()
+    _last_flush = now
+
+
+def summary(totals, elapsed, num_records):
+    """ One line with the rates of the main counters and the share of worker time in each stage """
+    busy = max(totals['elapsed_s'], 1e-9)
+    return ('{t:.0f}s, {r} records: {l:.0f} lines/s, {b:.1f} MB/s decompressed, {w:.0f} words kept. '
+            'Worker time: {n:.0%} network, {re:.0%} regex, {p:.0%} parsing').format(
+                t=elapsed, r=num_records, l=totals['lines'] / elapsed, b=totals['bytes'] / elapsed / 2**20,
+                w=totals['words'], n=totals['network_s'] / busy, re=totals['regex_s'] / busy,
+                p=totals['parse_s'] / busy)
+
+
+# this goes on a separate process
+def log_listener(q, metrics_path, summary_interval=30):
+    """ Writes the records sent by the workers as JSON lines to `metrics_path` and prints a summary of
+    the totals every `summary_interval` seconds. Stops at a None record """
+    start_time = last_summary = time.time()
+    totals = defaultdict(float)
+    num_records = 0
+    with open(metrics_path, 'a') as f:
+        while True:
+            try:
+                record = q.get()
+                if record is None:  # use None as sentinel
+                    break
+                print(json.dumps(record), file=f, flush=True)
+                num_records += 1
+                for name, value in record.items():
+                    if name not in ('time', 'pid', 'key'):
+                        totals[name] += value
+
+                if time.time() - last_summary > summary_interval:
+                    last_summary = time.time()
+                    print(summary(totals, last_summary - start_time, num_records), flush=True)
+
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception:
+                print('Whoops! Problem:', file=sys.stderr)
+                traceback.print_exc(file=sys.stderr)
+
+    print(summary(totals, time.time() - start_time, num_records), flush=True)
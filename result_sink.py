@@ -0,0 +1,205 @@
+import os
+import csv
+import json
+import sqlite3
+from os import path
+
+from manifest import write_atomic
+
+
+# columns of the `<journal>_gaussians` tables: the n-gram and each of its (up to 9) words, then the fit
+GRAM_COLUMNS = ['gram_' + str(i + 1) for i in range(9)]
+COLUMNS = ['nbg', 'gram'] + GRAM_COLUMNS + ['amplitude', 'center', 'sigma', 'residus', 'fit_quality']
+
+
+def fit_row(gram_tot, amplitude, center, sigma, residus, fit_quality):
+    """ The row of one fit, in the order of `COLUMNS`. Words missing from a shorter n-gram are empty """
+    gram_split = gram_tot.split(' ')
+    grams = gram_split + [''] * (len(GRAM_COLUMNS) - len(gram_split))
+    return (len(gram_split), gram_tot, *grams, float(amplitude), float(center), float(sigma),
+            float(residus), float(fit_quality))
+
+
+class ResultSink:
+    """ Collects fit rows and writes them by batches of `batch_size`, committing every `commit_every` rows,
+    or only when `commit()` is called if it is None. Subclasses implement `_write(rows)` and `_commit()`,
+    and `_write_progress(progress)` and `read_progress()` to record progress along with the rows.
+    Use as a context manager, or call `close()`, so that the last batch is written """
+    def __init__(self, batch_size=1000, commit_every=10000):
+        self.batch_size   = batch_size
+        self.commit_every = commit_every
+        self.rows = []
+        self.num_rows = 0
+        self.uncommitted = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def add_many(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def flush(self):
+        if self.rows:
+            self._write(self.rows)
+            self.num_rows += len(self.rows)
+            self.uncommitted += len(self.rows)
+            self.rows = []
+        if self.commit_every and self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self, progress=None):
+        """ Commits the rows written so far. `progress`, any JSON value (e.g. the number of words done),
+        is recorded in the same commit: after a crash, `read_progress()` gives the last one committed,
+        and exactly the rows committed with it are there """
+        if progress is not None:
+            self._write_progress(progress)
+        self._commit()
+        self.uncommitted = 0
+
+    def read_progress(self):
+        """ The `progress` of the last `commit`, or None """
+        return None
+
+    def close(self):
+        self.flush()
+        self.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write(self, rows):
+        raise NotImplementedError
+
+    def _commit(self):
+        pass
+
+    def _write_progress(self, progress):
+        raise NotImplementedError
+
+
+class DBSink(ResultSink):
+    """ Sink to `table` through a DB-API `connection`, one `executemany` per batch.
+    `placeholder` is the parameter marker of the driver: '%s' for pymysql, '?' for sqlite3.
+    The progress is the single row of `<table>_progress`, replaced in the transaction of the rows """
+    def __init__(self, connection, table, placeholder='%s', **kwargs):
+        super().__init__(**kwargs)
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.query = 'INSERT INTO {} ({}) VALUES ({})'.format(table, ','.join(COLUMNS),
+                                                             ','.join([placeholder] * len(COLUMNS)))
+        self.progress_table = table + '_progress'
+        self.placeholder = placeholder
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS {} (progress TEXT)'.format(self.progress_table))
+        self.connection.commit()
+
+    def _write(self, rows):
+        self.cursor.executemany(self.query, rows)
+
+    def _write_progress(self, progress):
+        self.cursor.execute('DELETE FROM ' + self.progress_table)
+        self.cursor.execute('INSERT INTO {} (progress) VALUES ({})'.format(self.progress_table, self.placeholder),
+                            (json.dumps(progress),))
+
+    def read_progress(self):
+        self.cursor.execute('SELECT progress FROM ' + self.progress_table)
+        row = self.cursor.fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def _commit(self):
+        self.connection.commit()
+
+    def close(self):
+        super().close()
+        self.connection.close()
+
+
+class SQLiteSink(DBSink):
+    """ Local sink to `table` of the SQLite database `db_path`, created if needed """
+    def __init__(self, db_path, table, **kwargs):
+        connection = sqlite3.connect(db_path)
+        connection.execute('CREATE TABLE IF NOT EXISTS {} (nbg INTEGER, gram TEXT, {}, amplitude REAL, center REAL, '
+                           'sigma REAL, residus REAL, fit_quality REAL)'.format(table, ', '.join(c + ' TEXT' for c in GRAM_COLUMNS)))
+        super().__init__(connection, table, placeholder='?', **kwargs)
+
+
+class MySQLSink(DBSink):
+    """ Sink to the MySQL server of the lab, as `gaus_fit` used to write. pymysql turns each `executemany`
+    into a multi-row INSERT, so a batch is a single round trip """
+    def __init__(self, table, host='cdh-dhlabpc3.epfl.ch', user='', password='', db='ling_cap', **kwargs):
+        import pymysql
+        connection = pymysql.connect(host=host, user=user, password=password, db=db, charset='utf8')
+        super().__init__(connection, table, placeholder='%s', **kwargs)
+
+
+class CSVSink(ResultSink):
+    """ Appends the rows to the CSV file `file_path`, with a header if it is new. Committing flushes the file.
+    The progress goes to `file_path.progress` with the size of the file when it was committed: a sink
+    reopened on the file first truncates the rows written after that commit """
+    def __init__(self, file_path, **kwargs):
+        super().__init__(**kwargs)
+        self.progress_path = file_path + '.progress'
+        self.progress = None
+        if path.exists(self.progress_path) and path.exists(file_path):
+            with open(self.progress_path) as f:
+                entry = json.load(f)
+            self.progress = entry['progress']
+            os.truncate(file_path, entry['offset'])
+        is_new = not path.exists(file_path)
+        self.file = open(file_path, 'a', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        if is_new:
+            self.writer.writerow(COLUMNS)
+
+    def _write(self, rows):
+        self.writer.writerows(rows)
+
+    def _commit(self):
+        self.file.flush()
+
+    def _write_progress(self, progress):
+        # the rows are on disk before the progress that counts them
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        entry = {'offset': self.file.tell(), 'progress': progress}
+        write_atomic(self.progress_path, lambda f: f.write(json.dumps(entry).encode('utf-8')))
+        self.progress = progress
+
+    def read_progress(self):
+        return self.progress
+
+    def close(self):
+        super().close()
+        self.file.close()
+
+
+class ListSink(ResultSink):
+    """ Keeps the rows in memory, in `written`, e.g. to send the fits of a word back from a worker """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.written = []
+        self.progress = None
+
+    def _write(self, rows):
+        self.written.extend(rows)
+
+    def _write_progress(self, progress):
+        self.progress = progress
+
+    def read_progress(self):
+        return self.progress
+
+
+SINKS = {'mysql': MySQLSink, 'sqlite': SQLiteSink, 'csv': CSVSink}
+
+
+def open_sink(kind, *args, **kwargs):
+    """ e.g. `open_sink('sqlite', 'fits.db', 'GDL_gaussians')` or `open_sink('csv', 'GDL_gaussians.csv')` """
+    if kind not in SINKS:
+        raise ValueError('Unknown sink %r, expected one of %s' % (kind, ', '.join(SINKS)))
+    return SINKS[kind](*args, **kwargs)
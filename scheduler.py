@@ -0,0 +1,172 @@
+import os, sys, json, time, queue
+import multiprocessing as mp
+from datetime import datetime
+
+import agg_download
+from agg_download import get_s3_bucket, prepare_root, pending_keys, retry_process_key, logger
+from manifest import write_atomic
+from utils import BASE_PATH
+
+
+TIMINGS_PATH = os.path.join(BASE_PATH, 'timings.json')
+
+# the estimate of `Agg_download.ipynb`: key.size / 2**30 * 6100 / 3.7 seconds per key
+DEFAULT_RATE = 2**30 * 3.7 / 6100
+
+
+class CostModel:
+    """ Learns how many (compressed) bytes per second a worker processes, from the keys that finished.
+
+    The timings of the keys are kept in `timings_path` (JSON, by key name), so that a later run starts
+    from what was observed instead of `DEFAULT_RATE` """
+    def __init__(self, timings_path=TIMINGS_PATH, window=20):
+        self.timings_path = timings_path
+        self.window  = window
+        self.timings = {}
+        if timings_path and os.path.exists(timings_path):
+            with open(timings_path) as f:
+                self.timings = json.load(f)
+        self.recent = []   # timings of this run, in the order they finished
+
+    def record(self, name, size, duration, cpu_time):
+        """ Adds the timing of a finished key """
+        timing = {'size': size, 'duration': round(duration, 1), 'cpu_time': round(cpu_time, 1),
+                  'date': datetime.now().isoformat(timespec='seconds')}
+        self.timings[name] = timing
+        self.recent.append(timing)
+
+    def rate(self):
+        """ Bytes per second of one worker: over the last keys of this run, else over the saved timings """
+        timings = self.recent[-self.window:] or list(self.timings.values())
+        size     = sum(t['size'] for t in timings)
+        duration = sum(t['duration'] for t in timings)
+        return size / duration if size and duration else DEFAULT_RATE
+
+    def cpu_ratio(self):
+        """ CPU time over wall time of the last keys: close to 1 when the workers are CPU bound,
+        low when they wait on the network. None before any key finished """
+        timings = self.recent[-self.window:]
+        duration = sum(t['duration'] for t in timings)
+        return sum(t['cpu_time'] for t in timings) / duration if duration else None
+
+    def estimate(self, size):
+        """ Seconds for one worker to process a key of `size` bytes """
+        return size / self.rate()
+
+    def eta(self, sizes, workers):
+        """ Seconds to process keys of `sizes` bytes with `workers` workers. The largest key can't be split,
+        so it bounds the estimate from below """
+        if not sizes:
+            return 0
+        return max(sum(sizes) / (self.rate() * workers), self.estimate(max(sizes)))
+
+    def save(self):
+        if self.timings_path:
+            write_atomic(self.timings_path, lambda f: f.write(json.dumps(self.timings, indent=1).encode('utf-8')))
+
+
+class Concurrency:
+    """ Adapts the number of keys processed at the same time, by hill climbing on the total throughput.
+
+    Every `window` finished keys, the throughput (bytes/s over all the workers) is compared with the previous
+    window: if it improved, the last change is repeated, otherwise it is reverted. When the workers are CPU
+    bound (`cpu_ratio` above `cpu_bound`) there is no point in having more of them than CPUs """
+    def __init__(self, initial, max_workers, window=None, cpu_bound=0.9):
+        self.limit = initial
+        self.max_workers = max_workers
+        self.window = window or initial
+        self.cpu_bound = cpu_bound
+        self.step = 1
+        self.prev_throughput = None
+        self.window_start, self.window_bytes, self.window_keys = time.time(), 0, 0
+
+    def update(self, size, cpu_ratio):
+        """ Called when a key of `size` bytes finished. Returns the new limit """
+        self.window_bytes += size
+        self.window_keys  += 1
+        if self.window_keys < self.window:
+            return self.limit
+
+        throughput = self.window_bytes / (time.time() - self.window_start)
+        if self.prev_throughput is not None and throughput < self.prev_throughput:
+            self.step = -self.step
+        self.prev_throughput = throughput
+
+        upper = self.max_workers
+        if cpu_ratio is not None and cpu_ratio > self.cpu_bound:
+            upper = min(upper, os.cpu_count())
+        self.limit = max(1, min(upper, self.limit + self.step))
+
+        self.window_start, self.window_bytes, self.window_keys = time.time(), 0, 0
+        return self.limit
+
+
+def timed_process_key(*args, **kw_args):
+    """ `retry_process_key`, also returning its wall and CPU time """
+    start, cpu_start = time.time(), time.process_time()
+    res = retry_process_key(*args, **kw_args)
+    return res, time.time() - start, time.process_time() - cpu_start
+
+
+def aggregate_adaptive(lang, n, start_year, end_year, engine='bytes', verify=False, max_workers=40, workers=None,
+                       timings_path=TIMINGS_PATH):
+    """ Same as `agg_download.aggregate`, but the number of keys in flight adapts to the observed throughput,
+    between 1 and `max_workers` (starting at `workers`, by default the number of CPUs). An ETA is logged
+    after each key, and the timings of the keys are saved to `timings_path` for the next runs """
+    root_path = prepare_root(lang, n, start_year, end_year)
+    if root_path is None:
+        return
+
+    agg_download.log_file = open("{l}{n}{date:%m-%d-%H-%M}-adaptive.log".format(
+        l=lang, n=n, date=datetime.now()), "a")
+    agg_download.start_time = time.time() - 1 # to avoid 0 time
+
+    keys = pending_keys(get_s3_bucket(), lang, n, root_path, verify)
+    model = CostModel(timings_path)
+    concurrency = Concurrency(min(workers or os.cpu_count(), max_workers), max_workers)
+    print('{info} {k} keys to process, ETA {eta:.0f}s'.format(
+        info=datetime.now(), k=len(keys), eta=model.eta([k.size for k, _ in keys], concurrency.limit)),
+        file=agg_download.log_file, flush=True)
+
+    done = queue.Queue()
+    pool = mp.Pool(max_workers)
+    in_flight = {}
+    try:
+        while keys or in_flight:
+            while keys and len(in_flight) < concurrency.limit:
+                key, key_path = keys.pop(0)
+                in_flight[key.name] = key
+                pool.apply_async(timed_process_key, (key, key_path, start_year, end_year, engine),
+                                 callback=lambda res, name=key.name: done.put((name, res)),
+                                 error_callback=lambda e, name=key.name: done.put((name, (str(e), 0, 0))))
+
+            name, (res, duration, cpu_time) = done.get()
+            key = in_flight.pop(name)
+            logger(res)
+            if type(res) is str:
+                continue
+
+            model.record(key.name, key.size, duration, cpu_time)
+            model.save()
+            cpu_ratio = model.cpu_ratio()
+            limit = concurrency.update(key.size, cpu_ratio)
+
+            # no ratio while the durations of the keys add up to 0s
+            cpu = 'n/a' if cpu_ratio is None else '{:.0%}'.format(cpu_ratio)
+            remaining = [k.size for k, _ in keys] + [k.size for k in in_flight.values()]
+            print('{info} {w} workers, {r:.0f} kbytes/s per worker, CPU {c}. ETA {eta:.0f}s'.format(
+                info=datetime.now(), w=limit, r=model.rate() / 2**10, c=cpu,
+                eta=model.eta(remaining, limit)), file=agg_download.log_file, flush=True)
+    finally:
+        pool.close()
+        pool.join()
+        agg_download.log_file.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 5:
+        print('Usage: python scheduler.py lang n start_year end_year')
+        print('Nothing done')
+        exit()
+
+    aggregate_adaptive(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]))
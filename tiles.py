@@ -0,0 +1,112 @@
+import zlib
+import struct
+import numpy as np
+from functools import lru_cache
+from PIL import Image, ImageFont, ImageDraw
+
+from manifest import write_atomic
+
+
+@lru_cache(maxsize=256)
+def get_font(font_path, font_size):
+    return ImageFont.truetype(font_path, font_size)
+
+
+def text_size(font, text):
+    """ (width, height) of `text`, as the removed `ImageDraw.textsize` gave them """
+    left, top, right, bottom = font.getbbox(text)
+    return right, bottom
+
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def write_png_rows(file_path, width, height, strips, level=6):
+    """ Writes an RGB PNG of `width` x `height` from `strips`, an iterable of `(rows, width, 3)` uint8
+    arrays from top to bottom. Each strip is compressed as it comes, so only one is ever in memory """
+    def write(f):
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(_png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        compressor = zlib.compressobj(level)
+        num_rows = 0
+        for strip in strips:
+            assert strip.shape[1:] == (width, 3), "Strip of the wrong width"
+            # each row starts with its filter type, 0 for none
+            raw = np.zeros((strip.shape[0], 1 + 3 * width), dtype=np.uint8)
+            raw[:, 1:] = strip.reshape(strip.shape[0], -1)
+            num_rows += strip.shape[0]
+            data = compressor.compress(raw.tobytes())
+            if data:
+                f.write(_png_chunk(b'IDAT', data))
+        assert num_rows == height, "Got %d rows instead of %d" % (num_rows, height)
+        f.write(_png_chunk(b'IDAT', compressor.flush()))
+        f.write(_png_chunk(b'IEND', b''))
+
+    write_atomic(file_path, write)
+
+
+def legend_labels(n, dates, angles, pos_dep, font_path):
+    """ The labels of `generate_date_circle` as small images: each one is drawn on its own and rotated about
+    the center of the chronocloud by moving its center there, instead of rotating a full `n` x `n` image.
+    Returns a list of `(label, top, left)` with white text on black """
+    font = get_font(font_path, int(0.02 * n))
+    labels = []
+    for text, angle in zip(dates, angles):
+        w, h = text_size(font, text)
+        pos_x = int(0.5 * n - 0.5 * w)
+        pos_y = int((1.0 - pos_dep) * 0.5 * n - 0.5 * h)
+        image = Image.new('RGB', (w, h), (0, 0, 0))
+        ImageDraw.Draw(image).text((0, 0), text, (255, 255, 255), font)
+        label = np.asarray(image.rotate(angle, expand=True))
+
+        # `Image.rotate` goes counter clockwise, with y pointing down
+        theta = np.radians(angle)
+        dx, dy = pos_x + 0.5 * w - 0.5 * n, pos_y + 0.5 * h - 0.5 * n
+        center_x = 0.5 * n + dx * np.cos(theta) + dy * np.sin(theta)
+        center_y = 0.5 * n - dx * np.sin(theta) + dy * np.cos(theta)
+        labels.append((label, int(round(center_y - 0.5 * label.shape[0])), int(round(center_x - 0.5 * label.shape[1]))))
+    return labels
+
+
+def _word_rows(layout, font_path):
+    """ First and last row that each word of `layout` can cover, whatever its orientation """
+    rows = np.empty((len(layout), 2), dtype=np.int64)
+    for i, ((word, _), font_size, position, orientation, color) in enumerate(layout):
+        left, top, right, bottom = get_font(font_path, font_size).getbbox(word)
+        rows[i] = position[0] - 1, position[0] + max(right, bottom) + 1
+    return rows
+
+
+def render_strips(n, layout, labels, font_path, strip_rows=1024):
+    """ Renders the words of `layout` (a `WordCloud.layout_` over the whole image) and the legend `labels`
+    `strip_rows` rows at a time. Each strip only draws the words and labels crossing it, and subtracts
+    the legend from the words in place. Yields `(rows, n, 3)` uint8 strips from top to bottom """
+    word_rows = _word_rows(layout, font_path)
+    for top in range(0, n, strip_rows):
+        bottom = min(top + strip_rows, n)
+        image = Image.new('RGB', (n, bottom - top), 'white')
+        draw  = ImageDraw.Draw(image)
+        crossing = np.flatnonzero((word_rows[:, 0] < bottom) & (word_rows[:, 1] >= top))
+        for i in crossing:
+            (word, _), font_size, position, orientation, color = layout[i]
+            font = ImageFont.TransposedFont(get_font(font_path, font_size), orientation=orientation)
+            draw.text((int(position[1]), int(position[0]) - top), word, fill=color, font=font)
+        strip = np.array(image)
+
+        for label, label_top, label_left in labels:
+            lo, hi = max(label_top, top), min(label_top + label.shape[0], bottom)
+            left, right = max(label_left, 0), min(label_left + label.shape[1], n)
+            if lo >= hi or left >= right:
+                continue
+            region = strip[lo - top:hi - top, left:right]
+            legend = label[lo - label_top:hi - label_top, left - label_left:right - label_left]
+            np.subtract(region, np.minimum(region, legend), out=region)
+        yield strip
+
+
+def render_tiled(file_path, n, layout, dates, angles, pos_dep, font_path, legend_font=None, strip_rows=1024):
+    """ Writes the chronocloud of `layout` with its date legend to the PNG `file_path`, in bounded memory:
+    a few strips of `strip_rows` x `n` pixels, whatever `n`. The legend uses `legend_font`, or `font_path` """
+    labels = legend_labels(n, dates, angles, pos_dep, legend_font or font_path)
+    write_png_rows(file_path, n, n, render_strips(n, layout, labels, font_path, strip_rows))
@@ -0,0 +1,19 @@
+import sys
+from utils import pickles_to_columnar, columnar_to_tiered
+
+
+def main(lang, n, start_year, end_year, dense_resilience=None):
+    """ Converts the per-key pickles of (lang, n, start, end) to the memory-mappable columnar store.
+    If `dense_resilience` is given, the words less resilient than it are then moved to sparse storage """
+    num_words = pickles_to_columnar(lang, int(n), int(start_year), int(end_year))
+    print('Wrote', num_words, 'words for', lang, n, start_year, end_year)
+    if dense_resilience is not None:
+        n_dense, n_sparse = columnar_to_tiered(lang, int(n), int(start_year), int(end_year), int(dense_resilience))
+        print('Kept', n_dense, 'dense words and moved', n_sparse, 'to sparse storage')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 5:
+        print('Usage: python to_columnar.py lang n start_year end_year [dense_resilience]')
+        sys.exit()
+    main(*sys.argv[1:6])
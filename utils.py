@@ -1,17 +1,325 @@
 import numpy as np
 import pandas as pd
 import numba
-import glob, pickle
+import glob, pickle, os
 from os import path
+from collections.abc import Mapping
 
+from manifest import is_complete
+from corpus import GOOGLE, get_corpus
 
-def load_google_counts(lang, n, start_year, end_year):
-    """ Get the dictionary of all the words for (lang, n, start, end) from filtered keys on disk """
+
+BASE_PATH = "/mnt/cluster-nas/ciprian/n-grams/"
+
+
+def counts_folder(lang, n, start_year, end_year, base_path=BASE_PATH):
+    """ Folder holding the aggregates for (lang, n, start, end), i.e. `base_path/lang/yS-E/n` """
     year_str = 'y{}-{}'.format(start_year, end_year)
-    base_path = "/mnt/cluster-nas/ciprian/n-grams/"
-    folder = path.join(base_path, lang, year_str, str(n))
+    return path.join(base_path, lang, year_str, str(n))
+
+
+class ColumnarCounts(Mapping):
+    """ Read-only dictionary view over a columnar count store.
+
+    `vocab` is a sorted array of words and `counts` a `(n_words, n_years)` matrix, typically memory-mapped,
+    whose row `i` holds the yearly counts of `vocab[i]`. Looking up a word is a binary search returning a
+    view of its row, so nothing is copied until the data is actually used.
+
+    Note: `pd.DataFrame(store)` does not understand mappings, use `store.to_frame()` instead.
+    """
+    def __init__(self, vocab, counts, start_year=None, year_totals=None, years=None):
+        assert len(vocab) == counts.shape[0], "Vocabulary and counts have different lengths"
+        self.vocab  = vocab
+        self.counts = counts
+        self.start_year  = start_year
+        self.years = years              # year of each column, when they are not contiguous from `start_year`
+        self.year_totals = year_totals  # counts per year over the whole corpus, if known
+
+    def _row(self, word):
+        idx = np.searchsorted(self.vocab, word)
+        if idx == len(self.vocab) or self.vocab[idx] != word:
+            raise KeyError(word)
+        return idx
+
+    def __getitem__(self, word):
+        return self.counts[self._row(word)]
+
+    def __contains__(self, word):
+        try:
+            self._row(word)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.vocab.tolist())
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def iter_chunks(self, chunk_size=2**16, prefixes=None):
+        """ Iterates over `(words, counts)` chunks of rows, like `iter_google_counts`.
+        Only the rows of words starting with one of `prefixes` are read, if it is given """
+        ranges = _prefix_ranges(self.vocab, prefixes) if prefixes else [(0, len(self))]
+        for lo, hi in ranges:
+            for chunk_lo in range(lo, hi, chunk_size):
+                chunk_hi = min(chunk_lo + chunk_size, hi)
+                yield self.vocab[chunk_lo:chunk_hi], self.counts[chunk_lo:chunk_hi]
+
+    def to_frame(self):
+        """ DataFrame with years as rows and words as columns, as `pd.DataFrame(word_counts)` would give """
+        df = pd.DataFrame(self.counts.T, columns=self.vocab)
+        if self.years is not None:
+            df.index = self.years
+        elif self.start_year is not None:
+            df.index += self.start_year
+        return df
+
+
+def _kept_columns(corpus, start_year, n_years):
+    """ Mask of the `n_years` columns from `start_year` that `corpus` doesn't exclude, all of them without corpus """
+    if corpus is None:
+        return np.ones(n_years, dtype=bool)
+    return get_corpus(corpus).mask_for(np.arange(n_years) + start_year)
+
+
+@numba.jit(nopython=True)
+def _nmb_csr_resilience(indptr, indices, rank, out):
+    """ Same as `word_resilience` for each row of a CSR matrix, whose columns are numbered by `rank`:
+    consecutive ranks are consecutive years, and the columns of rank -1 are skipped """
+    for i in range(indptr.shape[0] - 1):
+        res, rmax, prev = 0, 0, -2
+        for k in range(indptr[i], indptr[i + 1]):
+            col = rank[indices[k]]
+            if col < 0:
+                continue
+            res = res + 1 if col == prev + 1 else 1
+            rmax = max(rmax, res)
+            prev = col
+        out[i] = rmax
+
+
+def _to_csr(counts):
+    """ `(indptr, indices, data)` of the nonzero entries of the `(words, years)` matrix `counts` """
+    counts = np.asarray(counts)
+    nonzero = counts != 0
+    indptr  = np.zeros(counts.shape[0] + 1, dtype=np.int64)
+    np.cumsum(nonzero.sum(axis=1), out=indptr[1:])
+    indices = np.nonzero(nonzero)[1].astype(_index_dtype(counts.shape[1]))
+    return indptr, indices, counts[nonzero]
+
+
+def _index_dtype(n_years):
+    return np.uint8 if n_years <= 2**8 else np.uint16
+
+
+class SparseCounts(Mapping):
+    """ Read-only dictionary view over a CSR count store, for the long tail of the vocabulary.
+
+    Row `i` of the `(n_words, n_years)` count matrix holds the yearly counts of `vocab[i]`, but only its
+    nonzero entries are stored: `data[indptr[i]:indptr[i + 1]]` at years `indices[indptr[i]:indptr[i + 1]]`
+    (offsets from `start_year`). Looking up a word gives its dense row, like `ColumnarCounts`, and
+    `iter_chunks` densifies one chunk at a time, so the streaming functions work unchanged.
+    """
+    def __init__(self, vocab, indptr, indices, data, n_years, start_year=None, year_totals=None):
+        assert len(vocab) + 1 == len(indptr), "Vocabulary and row pointers have different lengths"
+        self.vocab   = vocab
+        self.indptr  = indptr
+        self.indices = indices
+        self.data    = data
+        self.n_years = n_years
+        self.start_year  = start_year
+        self.year_totals = year_totals
+
+    @classmethod
+    def from_dense(cls, vocab, counts, start_year=None, year_totals=None):
+        return cls(vocab, *_to_csr(counts), counts.shape[1], start_year, year_totals)
+
+    _row = ColumnarCounts._row
+    __contains__ = ColumnarCounts.__contains__
+    __iter__ = ColumnarCounts.__iter__
+    __len__  = ColumnarCounts.__len__
+
+    def __getitem__(self, word):
+        return self._dense_rows([self._row(word)])[0]
+
+    def _dense_rows(self, rows):
+        """ Dense `(len(rows), n_years)` matrix of the given rows """
+        rows    = np.asarray(rows, dtype=np.int64)
+        starts  = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        # positions of the entries of each row in `indices` and `data`, one row after the other
+        pos = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+        out = np.zeros((len(rows), self.n_years), dtype=self.data.dtype)
+        out[np.repeat(np.arange(len(rows)), lengths), self.indices[pos]] = self.data[pos]
+        return out
+
+    def iter_chunks(self, chunk_size=2**16, prefixes=None):
+        """ Iterates over dense `(words, counts)` chunks of rows, see `ColumnarCounts.iter_chunks` """
+        ranges = _prefix_ranges(self.vocab, prefixes) if prefixes else [(0, len(self))]
+        for lo, hi in ranges:
+            for chunk_lo in range(lo, hi, chunk_size):
+                chunk_hi = min(chunk_lo + chunk_size, hi)
+                yield self.vocab[chunk_lo:chunk_hi], self._dense_rows(np.arange(chunk_lo, chunk_hi))
+
+    def to_dense(self):
+        return ColumnarCounts(self.vocab, self._dense_rows(np.arange(len(self))), self.start_year, self.year_totals)
+
+    def to_frame(self):
+        return self.to_dense().to_frame()
+
+    def totals(self):
+        """ Counts per year summed over all the words """
+        totals = np.zeros(self.n_years, dtype=np.uint64)
+        np.add.at(totals, self.indices, self.data.astype(np.uint64))
+        return totals
+
+    def frequencies(self, year_totals=None):
+        """ Same store with the counts divided by `year_totals` (by default this store's `year_totals`,
+        or else its `totals()`). Stays sparse, since a zero count is a zero frequency """
+        if year_totals is None:
+            year_totals = self.year_totals if self.year_totals is not None else self.totals()
+        year_totals = np.asarray(year_totals, dtype=np.float64)
+        data = (self.data / year_totals[self.indices]).astype(np.float32)
+        return SparseCounts(self.vocab, self.indptr, self.indices, data, self.n_years,
+                            self.start_year, year_totals)
+
+    def resilience(self, years=None, corpus=None):
+        """ Resilience of every word, as `df_resilience` would give on the dense matrix, optionally
+        only over the (first, last) open interval of `years` and skipping the excluded years of `corpus` """
+        lo, hi = (0, self.n_years) if years is None else (years[0] - self.start_year, years[1] - self.start_year)
+        kept = _kept_columns(corpus, self.start_year, self.n_years)
+        kept[:lo] = kept[hi:] = False
+        rank = np.where(kept, np.cumsum(kept) - 1, -1)
+        out = np.empty(len(self), dtype=np.uint8)
+        _nmb_csr_resilience(self.indptr, self.indices, rank, out)
+        return out
+
+    def filter(self, years=None, min_count=0, min_resilience=0, corpus=None):
+        """ Like `filter_counts`, but evaluating the filters on the sparse rows and only making the
+        surviving ones dense. Returns a `ColumnarCounts` """
+        first, last = years if years else (self.start_year, self.start_year + self.n_years)
+        lo, hi = first - self.start_year, last - self.start_year
+        in_years = (self.indices >= lo) & (self.indices < hi)
+        rows = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+
+        year_totals = np.zeros(self.n_years, dtype=np.uint64)
+        np.add.at(year_totals, self.indices[in_years], self.data[in_years].astype(np.uint64))
+
+        keep = np.ones(len(self), dtype=bool)
+        if min_count:
+            counted = in_years & _kept_columns(corpus, self.start_year, self.n_years)[self.indices]
+            row_totals = np.bincount(rows[counted], self.data[counted], minlength=len(self))
+            keep &= row_totals >= min_count
+        if min_resilience:
+            keep &= self.resilience((first, last), corpus) >= min_resilience
+
+        kept = np.flatnonzero(keep)
+        counts = self._dense_rows(kept)
+        return ColumnarCounts(self.vocab[kept], counts[:, lo:hi], first, year_totals[lo:hi])
+
+
+class TieredCounts(Mapping):
+    """ A dense `ColumnarCounts` of the resilient words together with a `SparseCounts` of the long tail,
+    seen as a single store. Words are in exactly one tier; iteration goes through the dense tier first,
+    so it is sorted within each tier only. """
+    def __init__(self, dense, sparse):
+        self.dense  = dense
+        self.sparse = sparse
+        self.start_year  = dense.start_year
+        self.year_totals = None
+
+    def __getitem__(self, word):
+        try:
+            return self.dense[word]
+        except KeyError:
+            return self.sparse[word]
+
+    def __contains__(self, word):
+        return word in self.dense or word in self.sparse
+
+    def __iter__(self):
+        yield from self.dense
+        yield from self.sparse
+
+    def __len__(self):
+        return len(self.dense) + len(self.sparse)
+
+    @property
+    def vocab(self):
+        return np.concatenate([self.dense.vocab, self.sparse.vocab])
+
+    def iter_chunks(self, chunk_size=2**16, prefixes=None):
+        yield from self.dense.iter_chunks(chunk_size, prefixes)
+        yield from self.sparse.iter_chunks(chunk_size, prefixes)
+
+    def totals(self):
+        return self.dense.counts.sum(axis=0, dtype=np.uint64) + self.sparse.totals()
+
+    def resilience(self, years=None, corpus=None):
+        """ Resilience of every word, in the order of `vocab`, see `SparseCounts.resilience` """
+        first = years[0] if years else self.start_year
+        cols = slice(years[0] - self.start_year, years[1] - self.start_year) if years else slice(None)
+        dense = self.dense.counts[:, cols]
+        dense = dense[:, _kept_columns(corpus, first, dense.shape[1])]
+        return np.concatenate([_nmb_resilience(dense.T), self.sparse.resilience(years, corpus)])
+
+    def filter(self, years=None, min_count=0, min_resilience=0, corpus=None):
+        """ `filter_counts` on the dense tier and `SparseCounts.filter` on the sparse one, merged """
+        end_year = self.start_year + self.dense.counts.shape[1]
+        dense  = filter_counts(self.dense.iter_chunks(), self.start_year, end_year, years, min_count, min_resilience,
+                               corpus)
+        sparse = self.sparse.filter(years, min_count, min_resilience, corpus)
+        vocab  = np.concatenate([dense.vocab, sparse.vocab])
+        order  = np.argsort(vocab, kind='stable')
+        counts = np.concatenate([dense.counts, sparse.counts])[order]
+        return ColumnarCounts(vocab[order], counts, dense.start_year, dense.year_totals + sparse.year_totals)
+
+    def to_dense(self):
+        vocab = self.vocab
+        order = np.argsort(vocab, kind='stable')
+        counts = np.concatenate([np.asarray(self.dense.counts), self.sparse._dense_rows(np.arange(len(self.sparse)))])
+        return ColumnarCounts(vocab[order], counts[order], self.start_year)
+
+    def to_frame(self):
+        return self.to_dense().to_frame()
+
+
+def verify_counts(lang, n, start_year, end_year):
+    """ Checks each key on disk against the manifest written by `agg_download`.
+    Returns the list of keys that are incomplete or don't match their checksum """
+    folder = counts_folder(lang, n, start_year, end_year)
     assert path.isdir(folder), "Invalid path " + folder
 
+    return [path.basename(file) for file in sorted(glob.glob(path.join(folder, "*.pkl")))
+            if not is_complete(file, verify=True)]
+
+
+def load_google_counts(lang, n, start_year, end_year, verify=False):
+    """ Get the dictionary of all the words for (lang, n, start, end) from filtered keys on disk
+
+    If the folder holds a columnar store (see `pickles_to_columnar`) it is memory-mapped and returned
+    as a `ColumnarCounts`, which is near-instant, or as a `TieredCounts` if its long tail was moved
+    to sparse storage by `columnar_to_tiered`. Otherwise the per-key pickles are merged in a dict,
+    after checking them against their manifests if `verify` is set.
+    Both are read-only in practice: use `counts_frame` to get a DataFrame. """
+    folder = counts_folder(lang, n, start_year, end_year)
+    assert path.isdir(folder), "Invalid path " + folder
+
+    counts_path = path.join(folder, 'counts.npy')
+    if path.exists(counts_path):
+        vocab  = np.load(path.join(folder, 'vocab.npy'))
+        counts = np.load(counts_path, mmap_mode='r')
+        store  = ColumnarCounts(vocab, counts, start_year)
+        if path.exists(path.join(folder, 'sparse_indptr.npy')):
+            store = TieredCounts(store, load_sparse_counts(folder, counts.shape[1], start_year))
+        return store
+
+    if verify:
+        invalid = verify_counts(lang, n, start_year, end_year)
+        if invalid:
+            raise ValueError('Keys not matching their manifest in %s: %s' % (folder, ', '.join(invalid)))
+
     word_counts = {}
     for file in glob.iglob(path.join(folder, "*.pkl")):
         with open(file, 'rb') as f:
@@ -20,9 +328,264 @@ def load_google_counts(lang, n, start_year, end_year):
 
     return word_counts
 
-def get_filtered_df(counts_df, quantile=None):
+
+def counts_frame(word_counts, start_year):
+    """ DataFrame of counts with years as rows and words as columns from what `load_google_counts` returns.
+    A count store is a read-only mapping, which `pd.DataFrame` doesn't understand, so it goes through
+    `to_frame()`; the dict of the pickles is indexed from `start_year` """
+    if hasattr(word_counts, 'to_frame'):
+        return word_counts.to_frame()
+    df = pd.DataFrame(word_counts)
+    df.index += start_year
+    return df
+
+
+def pickles_to_columnar(lang, n, start_year, end_year):
+    """ Converts the per-key pickles of (lang, n, start, end) to a columnar store in the same folder.
+
+    Works in two passes so that at most one key is in memory besides the memory-mapped output:
+    first the vocabulary is collected, then each key's rows are written at their sorted position.
+    Words appearing in several keys have their counts added, like `.lower()` does inside a key.
+    """
+    folder = counts_folder(lang, n, start_year, end_year)
+    assert path.isdir(folder), "Invalid path " + folder
+    files = sorted(glob.glob(path.join(folder, "*.pkl")))
+
+    vocab = set()
+    for file in files:
+        with open(file, 'rb') as f:
+            vocab.update(pickle.load(f).keys())
+    vocab = np.array(sorted(vocab))
+
+    tmp_path = path.join(folder, 'counts.tmp.npy')
+    counts = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint32,
+                                       shape=(len(vocab), end_year - start_year))
+    for i, file in enumerate(files):
+        if i % 100 == 0:
+            print(lang, n, i, file)
+        with open(file, 'rb') as f:
+            key_wc = pickle.load(f)
+        if not key_wc:
+            continue
+        rows = np.searchsorted(vocab, list(key_wc.keys()))
+        np.add.at(counts, rows, np.array(list(key_wc.values()), dtype=np.uint32))
+
+    counts.flush()
+    del counts
+
+    # the vocabulary goes first, since the loader uses `counts.npy` as the marker of a complete store
+    np.save(path.join(folder, 'vocab.tmp.npy'), vocab)
+    os.replace(path.join(folder, 'vocab.tmp.npy'), path.join(folder, 'vocab.npy'))
+    os.replace(tmp_path, path.join(folder, 'counts.npy'))
+    return len(vocab)
+
+
+SPARSE_FILES = ['sparse_vocab', 'sparse_indptr', 'sparse_indices', 'sparse_data']
+
+
+def load_sparse_counts(folder, n_years, start_year=None):
+    """ Memory-maps the sparse tier written by `columnar_to_tiered` in `folder` """
+    vocab, indptr, indices, data = [np.load(path.join(folder, name + '.npy'), mmap_mode='r') for name in SPARSE_FILES]
+    return SparseCounts(np.asarray(vocab), indptr, indices, data, n_years, start_year)
+
+
+def columnar_to_tiered(lang, n, start_year, end_year, dense_resilience=50, chunk_rows=2**16):
+    """ Moves the long tail of the columnar store of (lang, n, start, end) to sparse storage.
+
+    Words with a resilience of at least `dense_resilience` stay in `counts.npy`, the others are written
+    in CSR form (see `SparseCounts`) to the `sparse_*.npy` files. A sparse entry takes 5 bytes where a
+    dense row takes 4 per year, and the hapax-like words that make most of the vocabulary have only a
+    handful of nonzero years. `load_google_counts` then returns a `TieredCounts` over both.
+    Returns the number of (dense, sparse) words.
+    """
+    folder = counts_folder(lang, n, start_year, end_year)
+    counts_path = path.join(folder, 'counts.npy')
+    assert path.exists(counts_path), "No columnar store in " + folder
+    assert not path.exists(path.join(folder, 'sparse_indptr.npy')), "Store already tiered in " + folder
+
+    vocab  = np.load(path.join(folder, 'vocab.npy'))
+    counts = np.load(counts_path, mmap_mode='r')
+    n_years = counts.shape[1]
+
+    # first pass: which rows stay dense, and how many entries the sparse ones have
+    dense = np.empty(len(vocab), dtype=bool)
+    nnz = 0
+    for lo in range(0, len(vocab), chunk_rows):
+        chunk = np.asarray(counts[lo:lo + chunk_rows])
+        dense[lo:lo + len(chunk)] = _nmb_resilience(chunk.T) >= dense_resilience
+        nnz += int(np.count_nonzero(chunk[~dense[lo:lo + len(chunk)]]))
+    sparse = ~dense
+    n_dense, n_sparse = int(dense.sum()), int(sparse.sum())
+
+    def tmp(name):
+        return path.join(folder, name + '.tmp.npy')
+
+    dense_counts = np.lib.format.open_memmap(tmp('counts'), mode='w+', dtype=counts.dtype, shape=(n_dense, n_years))
+    indptr  = np.lib.format.open_memmap(tmp('sparse_indptr'), mode='w+', dtype=np.int64, shape=(n_sparse + 1,))
+    indices = np.lib.format.open_memmap(tmp('sparse_indices'), mode='w+', dtype=_index_dtype(n_years), shape=(nnz,))
+    data    = np.lib.format.open_memmap(tmp('sparse_data'), mode='w+', dtype=counts.dtype, shape=(nnz,))
+
+    # second pass: copy each chunk to its tier
+    indptr[0] = 0
+    dense_row, sparse_row = 0, 0
+    for lo in range(0, len(vocab), chunk_rows):
+        chunk = np.asarray(counts[lo:lo + chunk_rows])
+        is_dense = dense[lo:lo + len(chunk)]
+        hot, cold = chunk[is_dense], chunk[~is_dense]
+        dense_counts[dense_row:dense_row + len(hot)] = hot
+
+        chunk_indptr, chunk_indices, chunk_data = _to_csr(cold)
+        base = indptr[sparse_row]
+        indptr[sparse_row + 1:sparse_row + len(cold) + 1] = base + chunk_indptr[1:]
+        indices[base:base + len(chunk_data)] = chunk_indices
+        data[base:base + len(chunk_data)] = chunk_data
+        dense_row, sparse_row = dense_row + len(hot), sparse_row + len(cold)
+
+    for array in (dense_counts, indptr, indices, data):
+        array.flush()
+    del counts, dense_counts, indptr, indices, data
+    np.save(tmp('vocab'), vocab[dense])
+    np.save(tmp('sparse_vocab'), vocab[sparse])
+
+    # `counts.npy` goes last: until then the new vocabulary doesn't match it and loading fails loudly
+    for name in ['vocab'] + SPARSE_FILES + ['counts']:
+        os.replace(tmp(name), path.join(folder, name + '.npy'))
+    return n_dense, n_sparse
+
+def _prefix_ranges(vocab, prefixes):
+    """ Row ranges [lo, hi) of the sorted `vocab` holding the words starting with any of `prefixes` """
+    ranges = []
+    for prefix in sorted(set(prefixes)):
+        lo = np.searchsorted(vocab, prefix)
+        hi = np.searchsorted(vocab, prefix + '\U0010ffff')
+        if ranges and lo <= ranges[-1][1]:   # overlapping prefixes, e.g. 'th' and 'the'
+            ranges[-1] = (ranges[-1][0], max(hi, ranges[-1][1]))
+        elif lo < hi:
+            ranges.append((lo, hi))
+    return ranges
+
+
+def _shard_may_match(shard, prefixes):
+    """ Keys are sharded by the first letters of the n-gram, so 'th.pkl' can only hold words starting with 'th' """
+    return any(shard.startswith(p) or p.startswith(shard) for p in prefixes)
+
+
+def iter_google_counts(lang, n, start_year, end_year, prefixes=None, chunk_size=2**16):
+    """ Streams the counts of (lang, n, start, end) as `(words, counts)` chunks, where `counts` is a
+    `(len(words), end_year - start_year)` matrix. Only the shards (or store rows) that can hold words
+    starting with one of `prefixes` are read, if it is given """
+    folder = counts_folder(lang, n, start_year, end_year)
+    assert path.isdir(folder), "Invalid path " + folder
+
+    if path.exists(path.join(folder, 'counts.npy')):
+        store = load_google_counts(lang, n, start_year, end_year)
+        yield from store.iter_chunks(chunk_size, prefixes)
+        return
+
+    for file in glob.iglob(path.join(folder, "*.pkl")):
+        shard = path.splitext(path.basename(file))[0]
+        if prefixes and not _shard_may_match(shard, prefixes):
+            continue
+        with open(file, 'rb') as f:
+            key_wc = pickle.load(f)
+        if not key_wc:
+            continue
+        words  = np.array(list(key_wc.keys()))
+        counts = np.array(list(key_wc.values()), dtype=np.uint32)
+        del key_wc
+        if prefixes:
+            keep = np.zeros(len(words), dtype=bool)
+            for prefix in prefixes:
+                keep |= np.char.startswith(words, prefix)
+            words, counts = words[keep], counts[keep]
+        yield words, counts
+
+
+def filter_counts(chunks, start_year, end_year, years=None, min_count=0, min_resilience=0, corpus=None):
+    """ Keeps only the rows of the `(words, counts)` chunks that pass the filters, one chunk at a time.
+
+    Parameters:
+    -----------
+        chunks        : iterable of (words, counts) as given by `iter_google_counts`
+        start_year    : year of the first column of `counts`
+        end_year      : year after the last column of `counts`
+        years         : (first, last) open interval of years to keep, e.g. (1840, 2001). Default: all
+        min_count     : keep words whose total count over `years` is at least this
+        min_resilience: keep words whose resilience over `years` is at least this
+        corpus        : a `corpus.Corpus` or its name, whose excluded years don't count in the filters
+
+    Returns a `ColumnarCounts` of the surviving words. Its `year_totals` are summed over all the streamed
+    words, before `min_count` and `min_resilience` are applied, so frequencies are not skewed by the filters.
+    All the columns of `years` are kept, the excluded years included.
+    """
+    first, last = years if years else (start_year, end_year)
+    assert start_year <= first < last <= end_year, "Years out of the stored range"
+    cols = slice(first - start_year, last - start_year)
+    kept = _kept_columns(corpus, first, last - first)
+
+    year_totals = np.zeros(last - first, dtype=np.uint64)
+    kept_words, kept_counts = [], []
+    for words, counts in chunks:
+        counts = counts[:, cols]
+        year_totals += counts.sum(axis=0, dtype=np.uint64)
+
+        keep = np.ones(len(words), dtype=bool)
+        if min_count:
+            keep &= counts[:, kept].sum(axis=1, dtype=np.uint64) >= min_count
+        if min_resilience:
+            keep &= _nmb_resilience(counts[:, kept].T) >= min_resilience
+        if keep.any():
+            kept_words.append(words[keep])
+            kept_counts.append(np.asarray(counts[keep]))   # fancy indexing copies, the shard can be released
+
+    if not kept_words:
+        return ColumnarCounts(np.array([], dtype=str), np.zeros((0, last - first), dtype=np.uint32),
+                              first, year_totals)
+
+    vocab  = np.concatenate(kept_words)
+    counts = np.concatenate(kept_counts)
+    order  = np.argsort(vocab, kind='stable')
+    return ColumnarCounts(vocab[order], counts[order], first, year_totals)
+
+
+def load_filtered_counts(lang, n, start_year, end_year, years=None, min_count=0, min_resilience=0, prefixes=None,
+                         corpus=None):
+    """ Loads only the words of (lang, n, start, end) that pass the filters, evaluated shard by shard.
+    See `filter_counts` for the filters; `prefixes` keeps only words starting with one of them and
+    avoids reading the shards that can't hold any. A tiered store is filtered without densifying its tail """
+    folder = counts_folder(lang, n, start_year, end_year)
+    if not prefixes and path.exists(path.join(folder, 'sparse_indptr.npy')):
+        return load_google_counts(lang, n, start_year, end_year).filter(years, min_count, min_resilience, corpus)
+
+    chunks = iter_google_counts(lang, n, start_year, end_year, prefixes)
+    return filter_counts(chunks, start_year, end_year, years, min_count, min_resilience, corpus)
+
+
+@numba.jit(nopython=True)
+def _nmb_permute_rows(mat, order):
+    """ In place, `mat[i] = mat[order[i]]` for all rows, using a single temporary row """
+    N = mat.shape[0]
+    done = np.zeros(N, dtype=np.bool_)
+    tmp  = np.empty(mat.shape[1], dtype=mat.dtype)
+    for start in range(N):
+        if done[start]:
+            continue
+        tmp[:] = mat[start]
+        i = start
+        while True:
+            done[i] = True
+            j = order[i]
+            if j == start:
+                mat[i] = tmp
+                break
+            mat[i] = mat[j]
+            i = j
+
+
+def get_filtered_df(counts_df, quantile=None, corpus=GOOGLE):
     ''' Returns a DataFrame of frequencies with years as rows and words as columns
     If `quantile` is given, only that percentile of most frequent words are kept
+    The excluded years of `corpus` (a `corpus.Corpus` or its name) are dropped
 
     Returns (df, ranks)
     '''
@@ -30,30 +593,86 @@ def get_filtered_df(counts_df, quantile=None):
 
     # find the words based on counts, rather than relative freqs
     word_ranks = counts_df.sum().rank(method='first')
+    words_to_keep = np.ones(counts_df.shape[1], dtype=bool)
     if quantile:
         assert(0 < quantile < 1)
-        words_to_keep = word_ranks > quantile * word_ranks.max()
+        words_to_keep = (word_ranks > quantile * word_ranks.max()).values
+        word_ranks = word_ranks[words_to_keep]
+
+    # remove empty years to avoid div by zero, and the excluded ones, e.g. 2009 for google since it's an outlier
+    year_totals = counts_df.sum(axis='columns')
+    years_to_keep = (year_totals > 0).values & get_corpus(corpus).mask_for(counts_df.index)
+
+    # a single copy of the kept part, then counts -> frequencies in place
+    freqs = counts_df.to_numpy()[np.ix_(years_to_keep, words_to_keep)].astype(np.float64, copy=False)
+    freqs /= year_totals.values[years_to_keep, None]
+    df = pd.DataFrame(freqs, index=counts_df.index[years_to_keep], columns=counts_df.columns[words_to_keep])
+
+    print("Filtered down to %d words" % df.shape[1])
+
+    return df, word_ranks
 
-    # make sure we don't modify the original
-    df = counts_df.copy()
 
-    # remove empty years to avoid div by zero
-    df = df.loc[counts_df.any(axis='columns'), :]
+def normalize_counts(store, quantile=None, corpus=GOOGLE, dtype=np.float32, out_path=None, chunk_size=2**16):
+    """ Out-of-core `get_filtered_df` for a count store such as `ColumnarCounts` or `TieredCounts`.
 
-    # remove 2009 since it's an outlier
-    df.drop(2009, axis='rows', inplace=True, errors='ignore')
+    A first pass over `store.iter_chunks()` gives the yearly totals and the rank of each word by total
+    count. The kept words (above `quantile`, if given) and years (not empty nor excluded from `corpus`) are then
+    known, so a second pass writes their frequencies directly in a `(words, years)` matrix of `dtype`,
+    memory-mapped to `out_path` if given. At most a few chunks are in memory besides the output.
 
-    # counts -> frequencies
-    df = df.div(df.sum(axis='columns'), axis='rows')
+    Returns (freqs, ranks), a `ColumnarCounts` whose `years` are the kept years, and the pd.Series of the
+    ranks of the kept words, as `get_filtered_df` would give on `store.to_frame()`.
+    """
+    n_years = None
+    year_totals, word_totals, vocab = 0, [], []
+    for words, counts in store.iter_chunks(chunk_size):
+        n_years = counts.shape[1]
+        year_totals = year_totals + counts.sum(axis=0, dtype=np.uint64)
+        word_totals.append(counts.sum(axis=1, dtype=np.uint64))
+        vocab.append(words)
+    assert n_years is not None, "Empty store"
+    word_totals = np.concatenate(word_totals)
+    vocab = np.concatenate(vocab)
+    print("Got %d words" % len(vocab))
 
-    # remove the rest of the words
+    # like `rank(method='first')`: ties are ranked in order of appearance
+    ranks = np.empty(len(vocab), dtype=np.float64)
+    ranks[np.argsort(word_totals, kind='stable')] = np.arange(1, len(vocab) + 1)
+    words_to_keep = np.ones(len(vocab), dtype=bool)
     if quantile:
-        df = df.loc[:, words_to_keep]
-        word_ranks = word_ranks[words_to_keep]
+        assert 0 < quantile < 1
+        words_to_keep = ranks > quantile * len(vocab)
+    del word_totals
 
-    print("Filtered down to %d words" % df.shape[1])
+    years = np.arange(n_years) + (store.start_year or 0)
+    years_to_keep = (year_totals > 0) & get_corpus(corpus).mask_for(years)
+    year_totals = year_totals[years_to_keep].astype(np.float64)
 
-    return df, word_ranks
+    shape = (int(words_to_keep.sum()), int(years_to_keep.sum()))
+    if out_path:
+        freqs = np.lib.format.open_memmap(out_path, mode='w+', dtype=dtype, shape=shape)
+    else:
+        freqs = np.empty(shape, dtype=dtype)
+
+    lo, row = 0, 0
+    for words, counts in store.iter_chunks(chunk_size):
+        keep = words_to_keep[lo:lo + len(words)]
+        chunk = counts[keep][:, years_to_keep]
+        freqs[row:row + len(chunk)] = chunk / year_totals
+        lo, row = lo + len(words), row + len(chunk)
+
+    vocab, ranks = vocab[words_to_keep], ranks[words_to_keep]
+    order = np.argsort(vocab, kind='stable')
+    if (order != np.arange(len(order))).any():   # e.g. the two tiers of a `TieredCounts`
+        _nmb_permute_rows(freqs, order)
+        vocab, ranks = vocab[order], ranks[order]
+    if out_path:
+        freqs.flush()
+
+    print("Filtered down to %d words" % shape[0])
+    freqs = ColumnarCounts(vocab, freqs, years=years[years_to_keep], year_totals=year_totals)
+    return freqs, pd.Series(ranks, index=vocab)
 
 
 
@@ -78,10 +697,14 @@ def _nmb_resilience(mat):
         result[i] = word_resilience(mat[:, i])
     return result
 
-def df_resilience(df):
+def df_resilience(df, corpus=None):
     ''' Calculates resilience for all words in DataFrame. One word per column.
+    If `corpus` is given, its excluded years are skipped rather than breaking the runs.
     Returns pd.Series indexed by words. '''
-    result = _nmb_resilience(df.values)
+    values = df.to_numpy()
+    if corpus is not None:
+        values = values[get_corpus(corpus).mask_for(df.index)]
+    result = _nmb_resilience(values)
     return pd.Series(result, index=df.columns)
 
 def filter_hapax(df, max_resilience=3):
@@ -90,3 +713,91 @@ def filter_hapax(df, max_resilience=3):
     return df.loc[:, ress > max_resilience]
 
 
+
+
+@numba.jit(nopython=True)
+def _longest_run(alive):
+    """ (length, start, end) of the first longest run of True in `alive`. Same convention as the
+    `word_new_resilience` of the notebooks, so a word never alive gives (0, 1, 0) """
+    res, res_max = 0, 0
+    end_max = 0
+    N = alive.shape[0]
+    for idx in range(N):
+        if alive[idx]:
+            res += 1
+        elif res <= res_max:
+            res = 0
+        else:
+            res_max = res
+            end_max = idx - 1
+            res = 0
+    if res > res_max:
+        res_max, end_max = res, N - 1
+    return res_max, end_max - res_max + 1, end_max
+
+
+@numba.jit(nopython=True, parallel=True)
+def _nmb_resilience_table(mat, year_totals, thres, out):
+    """ Fills `out[i]` with the runs of row `i` of `mat` (words on rows): the longest run of years with
+    counts, then the longest run of years with frequency above `thres` times the median frequency """
+    for i in numba.prange(mat.shape[0]):
+        row = mat[i]
+        out[i, 0], out[i, 1], out[i, 2] = _longest_run(row > 0)
+
+        freqs = row / year_totals
+        out[i, 3], out[i, 4], out[i, 5] = _longest_run(freqs > thres * np.median(freqs))
+
+
+RESILIENCE_FIELDS = ['res', 'start', 'end', 'alive_res', 'birth', 'death']
+
+
+def _row_chunks(counts, chunk_rows):
+    """ The rows of `counts`, a `(words, years)` matrix or a count store, `chunk_rows` at a time """
+    if hasattr(counts, 'iter_chunks'):
+        for _, chunk in counts.iter_chunks(chunk_rows):
+            yield chunk
+    else:
+        for lo in range(0, counts.shape[0], chunk_rows):
+            yield counts[lo:lo + chunk_rows]
+
+
+def resilience_table(counts, start_year=None, year_totals=None, thres=0.05, chunk_rows=2**16, corpus=None):
+    """ Resilience, birth and death of every word of `counts`, a `(words, years)` matrix such as
+    `ColumnarCounts.counts`, or a count store such as `TieredCounts` whose words are taken in the order of
+    its `vocab`. It is read `chunk_rows` rows at a time, so it can be memory-mapped.
+
+    For each word, gives the longest run of years with counts (`res`, from `start` to `end` included),
+    and the longest run of years where it is really alive (`alive_res`, from `birth` to `death`):
+    its frequency is above `thres` times its median frequency, as in `Words_analysis.ipynb`.
+    The frequencies are relative to `year_totals` (by default the column sums of `counts`), which
+    should have no empty year. Years are given from `start_year`, by default the first year of `corpus`,
+    or 0 without corpus. If `corpus` is given, its excluded years are skipped: a run goes on over them,
+    and they don't count in its length.
+
+    Returns a structured array with one uint16 field per entry of `RESILIENCE_FIELDS`; wrap it with
+    `pd.DataFrame(table, index=vocab)` if needed.
+    """
+    if year_totals is None:
+        year_totals = sum(chunk.sum(axis=0, dtype=np.uint64) for chunk in _row_chunks(counts, chunk_rows))
+    year_totals = np.asarray(year_totals, dtype=np.float64)
+
+    if start_year is None:
+        start_year = 0 if corpus is None else get_corpus(corpus).start_year
+    years = np.arange(len(year_totals)) + start_year
+    keep = np.ones(len(years), dtype=bool) if corpus is None else get_corpus(corpus).mask_for(years)
+    years, year_totals = years[keep], year_totals[keep]
+
+    table = np.empty(len(counts), dtype=[(field, np.uint16) for field in RESILIENCE_FIELDS])
+    out = np.empty((min(chunk_rows, len(counts)), len(RESILIENCE_FIELDS)), dtype=np.int64)
+    lo = 0
+    for chunk in _row_chunks(counts, chunk_rows):
+        chunk = np.ascontiguousarray(chunk if keep.all() else chunk[:, keep])
+        _nmb_resilience_table(chunk, year_totals, thres, out[:len(chunk)])
+        for j, field in enumerate(RESILIENCE_FIELDS):
+            table[field][lo:lo + len(chunk)] = out[:len(chunk), j]
+        lo += len(chunk)
+
+    # runs are in years, not indices of the kept years
+    for field in ['start', 'end', 'birth', 'death']:
+        table[field] = years[np.minimum(table[field], len(years) - 1)]
+    return table